@@ -6,6 +6,7 @@ import pandas as pd
 import os
 import yaml
 import json
+import jax
 import evofr as ef
 
 
@@ -17,6 +18,14 @@ def parse_with_default(cf, var, dflt):
         return dflt
 
 
+def enable_compilation_cache(path):
+    # Keep compiled programs on disk, so later runs load rather than
+    # recompile models of the same structure and shapes
+    os.makedirs(path, exist_ok=True)
+    jax.config.update("jax_compilation_cache_dir", path)
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+
+
 def parse_generation_time(cf_m):
     tau = parse_with_default(cf_m, "generation_time", 4.8)
     return tau
@@ -234,12 +243,24 @@ if __name__ == "__main__":
         "--pivot",
         help="Variant to use as pivot. Overrides model.pivot in config.",
     )
+    parser.add_argument(
+        "--compilation-cache-dir",
+        help="Directory of a persistent JAX compilation cache. "
+        + "Overrides settings.compilation_cache_dir in config.",
+    )
     args = parser.parse_args()
 
     # Load configuration, data, and create model
     config = MLRConfig(args.config)
     print(f"Config loaded: {config.path}")
 
+    compilation_cache_dir = args.compilation_cache_dir or config.config.get(
+        "settings", {}
+    ).get("compilation_cache_dir")
+    if compilation_cache_dir:
+        enable_compilation_cache(compilation_cache_dir)
+        print(f"Using compilation cache: {compilation_cache_dir}")
+
     raw_seq, locations = config.load_data(args.seq_path)
     print("Data loaded sucessfuly")
 
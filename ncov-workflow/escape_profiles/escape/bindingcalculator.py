@@ -12,7 +12,19 @@ Written by Jesse Bloom.
 __docformat__ = 'numpy'
 
 
+import collections
+import hashlib
+import json
+import os
+
+import numpy
 import pandas as pd
+import scipy.sparse
+
+
+ESCAPE_DATA_URL = 'https://raw.githubusercontent.com/jbloomlab/SARS2_RBD_Ab_escape_maps/main/processed_data/escape_calculator_data.csv'
+
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
 
 
 class BindingCalculator:
@@ -23,9 +35,11 @@ class BindingCalculator:
 
     Parameters
     ----------
-    csv_or_url : str
+    csv_or_url : str or pandas.DataFrame
         Path to CSV or URL of CSV containing the escape data. Should
-        have columns 'condition', 'metric', and 'escape'.
+        have columns 'condition', 'metric', and 'escape'. Can also be a data
+        frame already read from such a CSV, so that several calculators can be
+        built from a single read.
     eliciting_virus : str
         Include antibodies elicited by these viruses.
     known_to_neutralize : str
@@ -35,6 +49,14 @@ class BindingCalculator:
     mutation_escape_strength : float
         Scaling exponent :math:`s`; larger values mean stronger escape, see
         https://jbloomlab.github.io/SARS2_RBD_Ab_escape_maps/escape-calc/
+    cache_size : int
+        Maximum number of sets of mutated sites for which binding retained is
+        cached, evicting the least recently used. Set to 0 to disable caching.
+    cache_dir : str or None
+        Directory in which the cache is stored between runs, see
+        :meth:`BindingCalculator.save_cache`. The cache file is named by
+        :attr:`BindingCalculator.cache_key`, so it is only reused for the same
+        escape data and parameters.
 
     Attributes
     ----------
@@ -46,6 +68,12 @@ class BindingCalculator:
         of mutations at these sites.
     weight_by_log_IC50 : bool
         Value of `weight_by_log_IC50` passed as parameter.
+    matrix_sites : numpy.ndarray
+        Sorted sites giving the column order of the incidence matrices used
+        by :meth:`BindingCalculator.binding_retained_many`.
+    cache_key : str
+        Hash of the escape data read from `csv_or_url` and the parameters
+        that affect binding retained.
 
     Example
     -------
@@ -108,6 +136,12 @@ class BindingCalculator:
     2     B.1.1.7             [501]             0.940
     3     B.1.429             [452]             0.903
 
+    For many variants it is much faster to calculate binding retained for all
+    of them at once, which is done with a single matrix product:
+
+    >>> bindcalc.binding_retained_many(variants['mutated RBD sites']).round(3)
+    array([1.   , 0.689, 0.94 , 0.903])
+
     We can also calculate the escape remaining at each site after a mutation:
 
     >>> bindcalc.escape_per_site([417, 484]).query('site in [484, 486, 490]')
@@ -138,19 +172,56 @@ class BindingCalculator:
     137   486            0.080            0.067
     141   490            0.053            0.020
 
+    The escape retained at each site can also be calculated for many variants
+    at once, which gives a variant x site array with columns in the order of
+    :attr:`BindingCalculator.matrix_sites`:
+
+    >>> per_site = bindcalc.escape_per_site_many(variants['mutated RBD sites'])
+    >>> per_site.shape == (len(variants), len(bindcalc.matrix_sites))
+    True
+
+    Binding retained is cached by set of mutated sites, so repeated
+    calculations for the same sites are not recomputed:
+
+    >>> bindcalc_cached = BindingCalculator(
+    ...     csv_or_url='processed_data/escape_calculator_data.csv',
+    ... )
+    >>> bindcalc_cached.binding_retained_many([[484], [484], [417, 484], [484, 417]]).round(3)
+    array([0.817, 0.817, 0.733, 0.733])
+    >>> bindcalc_cached.cache_info()
+    CacheInfo(hits=2, misses=2, maxsize=100000, currsize=2)
+
     """
     def __init__(self,
-        csv_or_url='https://raw.githubusercontent.com/jbloomlab/SARS2_RBD_Ab_escape_maps/main/processed_data/escape_calculator_data.csv',
+        csv_or_url=ESCAPE_DATA_URL,
         *,
         eliciting_virus='SARS-CoV-2',
         known_to_neutralize="any",
         weight_by_log_IC50=True,
         mutation_escape_strength=2,
+        cache_size=100_000,
+        cache_dir=None,
     ):
         """See main class docstring."""
         # read escape data 
+        if isinstance(csv_or_url, pd.DataFrame):
+            raw_escape_data = csv_or_url.copy()
+        else:
+            raw_escape_data = pd.read_csv(csv_or_url)
+
+        # hash of escape data and parameters that identifies cached results
+        key_hash = hashlib.sha256(
+            pd.util.hash_pandas_object(raw_escape_data, index=False).values.tobytes()
+        )
+        key_hash.update(
+            repr(
+                (eliciting_virus, known_to_neutralize, weight_by_log_IC50, mutation_escape_strength)
+            ).encode()
+        )
+        self.cache_key = key_hash.hexdigest()
+
         self.escape_data = (
-            pd.read_csv(csv_or_url)
+            raw_escape_data
             .assign(
                 eliciting_virus=lambda x: x["eliciting_virus"].str.split(";"),
                 known_to_neutralize=lambda x: x["known_to_neutralize"].str.split(";"),
@@ -229,6 +300,121 @@ class BindingCalculator:
         else:
             self._n_conditions = self.escape_data['condition'].nunique()
 
+        # Precompute dense conditions x sites matrices of escape and of log
+        # binding retained when a site is mutated, so binding and escape
+        # retained for many sets of mutated sites are matrix products with a
+        # sparse strain x site incidence matrix. Sites that fully escape a
+        # condition are floored at the smallest positive float so the log
+        # stays finite.
+        conditions = (
+            self.escape_data[["condition", "neg_log_IC50"]]
+            .drop_duplicates()
+            .sort_values("condition")
+            .reset_index(drop=True)
+        )
+        self.matrix_sites = numpy.array(sorted(self.sites))
+        self._site_to_col = {site: i for i, site in enumerate(self.matrix_sites)}
+        cond_to_row = {cond: i for i, cond in enumerate(conditions["condition"])}
+        rows = self.escape_data["condition"].map(cond_to_row).values
+        cols = self.escape_data["site"].map(self._site_to_col).values
+        self._escape = numpy.zeros((len(conditions), len(self.matrix_sites)))
+        self._escape[rows, cols] = self.escape_data["escape"].values.astype(float)
+        self._log_retain = numpy.zeros((len(conditions), len(self.matrix_sites)))
+        self._log_retain[rows, cols] = numpy.log(
+            numpy.maximum(
+                1 - self.escape_data["scale_escape"].values.astype(float),
+                numpy.finfo(float).tiny,
+            )
+        )
+        if self.weight_by_log_IC50:
+            self._weights = conditions["neg_log_IC50"].values.astype(float)
+        else:
+            self._weights = numpy.ones(len(conditions))
+
+        # least recently used cache of binding retained by set of mutated sites
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._cache_path = (
+            None if cache_dir is None else os.path.join(cache_dir, f"{self.cache_key}.json")
+        )
+        if self._cache_size > 0 and self._cache_path is not None and os.path.isfile(self._cache_path):
+            with open(self._cache_path) as f:
+                for sites, binding_retained in json.load(f)[-self._cache_size:]:
+                    self._cache[frozenset(sites)] = binding_retained
+
+    def cache_info(self):
+        """Statistics of the binding retained cache.
+
+        Returns
+        -------
+        CacheInfo
+            Named tuple of cache `hits`, `misses`, `maxsize`, and `currsize`.
+            A miss is counted once per distinct set of mutated sites computed.
+
+        """
+        return CacheInfo(self._cache_hits, self._cache_misses, self._cache_size, len(self._cache))
+
+    def save_cache(self):
+        """Write cached binding retained to `cache_dir` for reuse in later runs."""
+        if self._cache_path is None:
+            raise ValueError("cannot save cache without a `cache_dir`")
+        os.makedirs(os.path.dirname(self._cache_path) or ".", exist_ok=True)
+        with open(self._cache_path, "w") as f:
+            json.dump(
+                [(sorted(int(site) for site in sites), binding_retained)
+                 for sites, binding_retained in self._cache.items()],
+                f,
+            )
+
+    def site_incidence(self, mutated_sites_list):
+        """Sparse incidence matrix of mutated sites for many variants.
+
+        Parameters
+        ----------
+        mutated_sites_list : list of array-like of integers
+            For each variant, list of mutated sites, must all be in
+            :attr:`BindingCalculator.sites`.
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            Variant x site matrix with columns in the order of
+            :attr:`BindingCalculator.matrix_sites`, which is 1 where the site
+            is mutated in that variant.
+
+        """
+        indptr = [0]
+        indices = []
+        for mutated_sites in mutated_sites_list:
+            mutated_sites = set(mutated_sites)
+            if not mutated_sites.issubset(self.sites):
+                raise ValueError(f"invalid sites: {mutated_sites - self.sites}")
+            indices.extend(self._site_to_col[site] for site in mutated_sites)
+            indptr.append(len(indices))
+        return scipy.sparse.csr_matrix(
+            (numpy.ones(len(indices)), indices, indptr),
+            shape=(len(indptr) - 1, len(self.matrix_sites)),
+        )
+
+    def _incidence(self, mutated_sites):
+        """Incidence matrix from sets of mutated sites or a sparse matrix."""
+        if scipy.sparse.issparse(mutated_sites):
+            incidence = mutated_sites
+        else:
+            incidence = self.site_incidence(mutated_sites)
+        if incidence.shape[1] != len(self.matrix_sites):
+            raise ValueError(f"{incidence.shape=} does not match {len(self.matrix_sites)=}")
+        return incidence
+
+    def _cond_bind_retain(self, incidence):
+        """Variant x condition binding retained for an incidence matrix."""
+        return numpy.exp(
+            self.mutation_escape_strength
+            * numpy.asarray(incidence @ self._log_retain.T)
+        )
+
     def escape_per_site(self, mutated_sites):
         """Escape at each site after mutating indicated sites.
 
@@ -244,34 +430,34 @@ class BindingCalculator:
             retained after mutations.
 
         """
-        mutated_sites = set(mutated_sites)
-        if not mutated_sites.issubset(self.sites):
-            raise ValueError(f"invalid sites: {mutated_sites - self.sites}")
-        df = (
-            self.escape_data
-            .assign(
-                mutated=lambda x: x['site'].isin(mutated_sites).astype(int),
-                site_bind_retain=lambda x: 1 - x['scale_escape'] * x['mutated']
-                )
-            .groupby(['condition', "neg_log_IC50"], as_index=False)
-            .aggregate(cond_bind_retain=pd.NamedAgg('site_bind_retain', "prod"))
-            .assign(
-                cond_bind_retain=lambda x: x["cond_bind_retain"].pow(self.mutation_escape_strength),
-                weight=lambda x: x["neg_log_IC50"] if self.weight_by_log_IC50 else 1,
-            )
-            [["condition", 'cond_bind_retain', "weight"]]
-            .merge(self.escape_data[['condition', 'site', 'escape']])
-            .assign(
-                escape=lambda x: x["escape"] * x["weight"],
-                retained_escape=lambda x: x['cond_bind_retain'] * x['escape'],
-            )
-            .groupby('site')
-            .aggregate(
-                original_escape=pd.NamedAgg('escape', 'sum'),
-                retained_escape=pd.NamedAgg('retained_escape', 'sum'),
-            )
-        ) / self._n_conditions
-        return df.reset_index()
+        retained_escape = self.escape_per_site_many([mutated_sites])[0]
+        return pd.DataFrame({
+            "site": self.matrix_sites,
+            "original_escape": self._weights @ self._escape / self._n_conditions,
+            "retained_escape": retained_escape,
+        })
+
+    def escape_per_site_many(self, mutated_sites):
+        """Escape retained at each site for many sets of mutated sites at once.
+
+        Parameters
+        ----------
+        mutated_sites : list of array-like of integers or scipy.sparse matrix
+            For each variant, list of mutated sites, must all be in
+            :attr:`BindingCalculator.sites`. Alternatively, a sparse
+            incidence matrix as returned by
+            :meth:`BindingCalculator.site_incidence`.
+
+        Returns
+        -------
+        numpy.ndarray
+            Variant x site array of the escape retained after mutations, with
+            columns in the order of :attr:`BindingCalculator.matrix_sites`.
+
+        """
+        incidence = self._incidence(mutated_sites)
+        weighted_cond_bind_retain = self._cond_bind_retain(incidence) * self._weights
+        return weighted_cond_bind_retain @ self._escape / self._n_conditions
 
     def binding_retained(self, mutated_sites):
         """Fraction binding retained after mutating indicated sites.
@@ -287,27 +473,66 @@ class BindingCalculator:
             The fraction binding retained after these mutations.
 
         """
-        mutated_sites = set(mutated_sites)
-        if not mutated_sites.issubset(self.sites):
-            raise ValueError(f"invalid sites: {mutated_sites - self.sites}")
-        binding_retained = (
-            self.escape_data
-            .assign(
-                mutated=lambda x: x['site'].isin(mutated_sites).astype(int),
-                site_bind_retain=lambda x: 1 - x['scale_escape'] * x['mutated'],
-            )
-            .groupby(['condition', 'neg_log_IC50'], as_index=False)
-            .aggregate(cond_bind_retain=pd.NamedAgg('site_bind_retain', "prod"))
-            .assign(
-                cond_bind_retain=lambda x: x["cond_bind_retain"].pow(self.mutation_escape_strength),
-                weight=lambda x: x["neg_log_IC50"] if self.weight_by_log_IC50 else 1,
-                weighted_cond_bind_retain=lambda x: x["cond_bind_retain"] * x["weight"],
-            )
-            ['weighted_cond_bind_retain']
-            .sum()
-        ) / self._n_conditions
+        return float(self.binding_retained_many([mutated_sites])[0])
+
+    def binding_retained_many(self, mutated_sites):
+        """Fraction binding retained for many sets of mutated sites at once.
+
+        Parameters
+        ----------
+        mutated_sites : list of array-like of integers or scipy.sparse matrix
+            For each variant, list of mutated sites, must all be in
+            :attr:`BindingCalculator.sites`. Alternatively, a sparse
+            incidence matrix as returned by
+            :meth:`BindingCalculator.site_incidence`.
+
+        Returns
+        -------
+        numpy.ndarray
+            The fraction binding retained for each variant.
+
+        Notes
+        -----
+        Results for lists of mutated sites are looked up in and added to the
+        cache, and each distinct set of mutated sites is only computed once.
+        Sparse incidence matrices bypass the cache.
+
+        """
+        if scipy.sparse.issparse(mutated_sites):
+            return self._binding_retained(self._incidence(mutated_sites))
+
+        mutated_sites = list(mutated_sites)
+        binding_retained = numpy.empty(len(mutated_sites))
+        uncached = collections.defaultdict(list)
+        for i, sites in enumerate(mutated_sites):
+            key = frozenset(sites)
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                binding_retained[i] = self._cache[key]
+                self._cache_hits += 1
+            else:
+                uncached[key].append(i)
+
+        if uncached:
+            self._cache_misses += len(uncached)
+            self._cache_hits += sum(len(idx) - 1 for idx in uncached.values())
+            computed = self._binding_retained(self.site_incidence(uncached))
+            for (key, idx), value in zip(uncached.items(), computed):
+                binding_retained[idx] = value
+                if self._cache_size > 0:
+                    self._cache[key] = float(value)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
         return binding_retained
 
+    def _binding_retained(self, incidence):
+        """Fraction binding retained for each row of an incidence matrix."""
+        # computed as one minus the weighted binding lost so that variants
+        # with no mutations retain exactly all binding
+        binding_lost = (1 - self._cond_bind_retain(incidence)) @ self._weights
+        return 1 - binding_lost / self._n_conditions
+
 
 if __name__ == '__main__':
     import doctest
@@ -1,12 +1,110 @@
 import argparse, os, glob, sys
-from Bio import AlignIO, SeqIO, SeqFeature, Seq
+import contextlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 import numpy
 import pandas as pd
 from augur.utils import write_json
 
 # enable importation of bindingcalculator from subdir of this script
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
-from bindingcalculator import BindingCalculator
+from bindingcalculator import BindingCalculator, ESCAPE_DATA_URL
+
+# escape profile used when none are given: node attribute name mapped to
+# keyword arguments of BindingCalculator
+DEFAULT_PROFILES = {
+    "escape_score": {
+        "eliciting_virus": "SARS-CoV-2",
+        "known_to_neutralize": "Omicron BA.2",
+    },
+}
+
+# binding calculators of the profiles scored by this process, set once per
+# worker process
+_shared = {}
+
+
+def _init_shared(escape_data, profiles, cache_dir):
+    _shared["cache_dir"] = cache_dir
+    _shared["calculators"] = {
+        name: BindingCalculator(escape_data, cache_dir=cache_dir, **params)
+        for name, params in profiles.items()
+    }
+
+
+def score_profiles(mutated_sites):
+    """Binding retained for each set of mutated sites under each profile of this process."""
+    return {
+        name: bindcalc.binding_retained_many(mutated_sites)
+        for name, bindcalc in _shared["calculators"].items()
+    }
+
+
+def finish_profiles():
+    """Report and save the binding retained cache of each profile of this process."""
+    for name, bindcalc in _shared["calculators"].items():
+        print(f"Binding retained cache for {name}: {bindcalc.cache_info()}")
+        if _shared["cache_dir"]:
+            bindcalc.save_cache()
+
+
+def rbd_differences(alignment_path, reference, rbd_start, rbd_end, chunk_size):
+    """Stream RBD mutations relative to `reference` for chunks of records.
+
+    Records are read one at a time and the RBD window of each chunk of
+    records is compared to the reference as a single `uint8` array, so
+    memory use does not depend on the size of the alignment. A site is
+    mutated if it differs from the reference and neither is a gap, and the
+    record does not have an ambiguous amino acid there.
+
+    Yields
+    ------
+    pandas.DataFrame
+        Columns "strain", "mutated RBD sites", and "RBD mutations" for each
+        chunk of records.
+    """
+    window_length = rbd_end - rbd_start
+    ref_window = numpy.frombuffer(reference[rbd_start - 1: rbd_end - 1].encode(), dtype=numpy.uint8)
+    window_sites = numpy.arange(rbd_start, rbd_end)
+
+    def _diffs(strains, windows):
+        chunk = numpy.frombuffer("".join(windows).encode(), dtype=numpy.uint8).reshape(len(strains), window_length)
+        mutated = (
+            (chunk != ref_window)
+            & (ref_window != ord("-"))
+            & (chunk != ord("-"))
+            & (chunk != ord("X"))
+        )
+        rows, cols = numpy.nonzero(mutated)
+        sites = window_sites[cols]
+        mutations = numpy.char.add(
+            numpy.char.add(ref_window[cols].view("S1").astype(str), sites.astype(str)),
+            chunk[rows, cols].view("S1").astype(str),
+        )
+        splits = numpy.cumsum(mutated.sum(axis=1))[:-1]
+        return pd.DataFrame({
+            "strain": strains,
+            "mutated RBD sites": [s.tolist() for s in numpy.split(sites, splits)],
+            "RBD mutations": [m.tolist() for m in numpy.split(mutations, splits)],
+        })
+
+    strains = []
+    windows = []
+    with open(alignment_path) as handle:
+        for title, seq in SimpleFastaParser(handle):
+            window = seq[rbd_start - 1: rbd_end - 1]
+            if len(window) != window_length:
+                raise ValueError(f"sequence for {title!r} is shorter than the RBD end {rbd_end}")
+            strains.append(title.split(None, 1)[0])
+            windows.append(window)
+            if len(strains) == chunk_size:
+                yield _diffs(strains, windows)
+                strains = []
+                windows = []
+    if strains:
+        yield _diffs(strains, windows)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -17,6 +115,12 @@ if __name__ == '__main__':
     parser.add_argument('--alignment', type=str, required=False, help="spike AA alignment")
     parser.add_argument('--output', type=str, required=True, help="JSON of escape estimates for nodes")
     parser.add_argument('--output-csv', type=str, required=True, help="CSV of escape data")
+    parser.add_argument('--cache-dir', type=str, help="directory to keep binding retained for sets of mutated sites between runs")
+    parser.add_argument('--chunk-size', type=int, default=10_000, help="number of records to compare to the reference at once")
+    parser.add_argument('--escape-data', type=str, default=ESCAPE_DATA_URL, help="path or URL of CSV of escape data shared by all profiles")
+    parser.add_argument('--profiles', type=str, help="JSON mapping node attribute names to BindingCalculator keyword arguments, one attribute per escape profile. "
+                        "If not given, scores a single 'escape_score' for antibodies elicited by SARS-CoV-2 and known to neutralize Omicron BA.2.")
+    parser.add_argument('--threads', type=int, default=1, help="number of processes used to score profiles")
     args = parser.parse_args()
 
     # Trevor added this hardcoded reference: it seems kind of hacky and should
@@ -26,47 +130,78 @@ if __name__ == '__main__':
     length = len(reference)
     assert "X" not in reference, "reference has ambiguous amino acids"
 
-    alignment = AlignIO.read(args.alignment, 'fasta')
-
-    # get RBD mutations and mutated sites for each strain
-    rbd_start = 331  # start of RBD
-    rbd_end = 531  # end of RBD
-    records = []
-    for record in alignment:
-        mutated_rbd_sites = []
-        rbd_mutations = []
-        for site in range(rbd_start, rbd_end):
-            ref_aa = reference[site - 1]
-            aa = str(record.seq[site - 1])
-            if (ref_aa != aa) and (ref_aa != "-" and aa != "-") and (aa != "X"):
-                mutated_rbd_sites.append(site)
-                rbd_mutations.append(f"{ref_aa}{site}{aa}")
-        records.append((record.name, mutated_rbd_sites, rbd_mutations))
-    # convert to data frame
-    diffs_df = pd.DataFrame(
-        records,
-        columns=["strain", "mutated RBD sites", "RBD mutations"],
-    )
+    profiles = json.loads(args.profiles) if args.profiles else DEFAULT_PROFILES
+    escape_data = pd.read_csv(args.escape_data)
 
-    # compute escape, which is negative log2 binding retained
-    bindcalc = BindingCalculator(
-        eliciting_virus="SARS-CoV-2",
-        known_to_neutralize="Omicron BA.2",
-    )
-    log_base = 2
-    escape_df = diffs_df.assign(
-        binding_retained=lambda x: x["mutated RBD sites"].map(bindcalc.binding_retained),
-        escape_score=lambda x: -numpy.log(x["binding_retained"]) / numpy.log(log_base),
-    )
+    # score profiles in this process, or split them between worker processes
+    # that each keep the binding calculators of their profiles for the whole run
+    with contextlib.ExitStack() as stack:
+        n_workers = min(args.threads, len(profiles))
+        if n_workers > 1:
+            names = list(profiles)
+            executors = [
+                stack.enter_context(ProcessPoolExecutor(
+                    max_workers=1,
+                    initializer=_init_shared,
+                    initargs=(escape_data, {name: profiles[name] for name in names[i::n_workers]}, args.cache_dir),
+                ))
+                for i in range(n_workers)
+            ]
+
+            def score(mutated_sites):
+                futures = [executor.submit(score_profiles, mutated_sites) for executor in executors]
+                return {name: br for future in futures for name, br in future.result().items()}
+
+            def finish():
+                for future in [executor.submit(finish_profiles) for executor in executors]:
+                    future.result()
+        else:
+            _init_shared(escape_data, profiles, args.cache_dir)
+            score, finish = score_profiles, finish_profiles
+
+        # get RBD mutations and mutated sites for chunks of strains in one pass
+        # over the alignment, numbering each distinct set of mutated sites and
+        # scoring the sets new in each chunk under every profile, then compute
+        # escape for the chunk and append it to the CSV, which is useful for debugging
+        rbd_start = 331  # start of RBD
+        rbd_end = 531  # end of RBD
+        log_base = 2
+        patterns = {}
+        binding_retained = {name: numpy.empty(0) for name in profiles}
+        escape_scores = []
+        n_strains = 0
+        for i, escape_df in enumerate(rbd_differences(args.alignment, reference, rbd_start, rbd_end, args.chunk_size)):
+            new_sites = []
+            pattern = numpy.empty(len(escape_df), dtype=int)
+            for j, sites in enumerate(escape_df["mutated RBD sites"]):
+                key = frozenset(sites)
+                if key not in patterns:
+                    patterns[key] = len(patterns)
+                    new_sites.append(sites)
+                pattern[j] = patterns[key]
+            if new_sites:
+                for name, br in score(new_sites).items():
+                    binding_retained[name] = numpy.concatenate([binding_retained[name], br])
+
+            # compute escape, which is negative log2 binding retained
+            for name in profiles:
+                # the default profile keeps the column name of the single-profile CSV
+                column = "binding_retained" if name == "escape_score" else f"{name}_binding_retained"
+                escape_df[column] = binding_retained[name][pattern]
+                escape_df[name] = -numpy.log(escape_df[column]) / numpy.log(log_base)
+
+            escape_df.to_csv(args.output_csv, mode="w" if i == 0 else "a", header=(i == 0), index=False, float_format="%.3g")
+            escape_scores.append(escape_df[["strain", *profiles]])
+            n_strains += len(escape_df)
 
-    # write to CSV, which is useful for debugging
-    escape_df.to_csv(args.output_csv, index=False, float_format="%.3g")
+        print(f"Found {len(patterns)} distinct sets of mutated RBD sites in {n_strains} strains")
+        finish()
 
-    # output JSON with escape scores for each strain
+    # output JSON with escape scores for each strain, one attribute per profile
     escape_dict = (
-        escape_df
+        pd.concat(escape_scores)
         .set_index("strain")
-        [["escape_score"]]
+        [list(profiles)]
         .round(3)
         .to_dict(orient="index")
     )
@@ -1254,6 +1254,11 @@ rule mutational_fitness:
             --output {output} 2>&1 | tee {log}
         """
 
+def _get_escape_score_profiles(wildcards):
+    import json
+    profiles = config.get("escape_score", {}).get("profiles")
+    return f"--profiles '{json.dumps(profiles)}'" if profiles else ""
+
 rule escape_score:
     input:
         alignment = "results/escape/translations/aligned.gene.S_withInternalNodes.fasta",
@@ -1266,6 +1271,10 @@ rule escape_score:
         "logs/escape_score_{build_name}.txt"
     conda:
         config["conda_environment"],
+    threads: 4
+    params:
+        cache_dir=lambda w: f"--cache-dir {config['escape_score']['cache_dir']}" if config.get("escape_score", {}).get("cache_dir") else "",
+        profiles=_get_escape_score_profiles,
     resources:
         mem_mb=2000
     shell:
@@ -1273,7 +1282,10 @@ rule escape_score:
         python3 escape_profiles/escape/sequence_to_escape.py \
             --alignment {input.alignment} \
             --output {output.node_data} \
-            --output-csv {output.csv}
+            --output-csv {output.csv} \
+            --threads {threads} \
+            {params.profiles} \
+            {params.cache_dir}
         """
 
 rule calculate_epiweeks:
@@ -0,0 +1,235 @@
+"""
+Batched MAP inference of the innovation MLR over many locations at once.
+
+Each location's sequence counts, time features and innovation matrix are
+padded to a shared variant x time grid, with masks so padded variants and
+days add nothing to the objective. The MAP optimization of every location
+then runs as a single jit-compiled loop vectorized with `jax.vmap` over
+locations, so the model is compiled once however many locations are fit.
+The fitted parameters are unpadded and passed through each location's own
+evofr model, so posteriors look the same as those from `ef.InferMAP`.
+
+The grid can also be rounded up to one of a few bucket sizes with
+`bucket_size`, so that fits of different windows or locations, whose numbers
+of variants and days differ, share the same shapes. Their compiled
+optimization is then reused within a process and from JAX's persistent
+compilation cache, rather than compiled again for every fit.
+"""
+import functools
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import numpyro
+import numpyro.distributions as dist
+from jax import lax, random
+from numpyro.infer import SVI, Predictive, Trace_ELBO
+from numpyro.infer.autoguide import AutoDelta
+from numpyro.optim import Adam
+
+# Logit of padded variants, which gives them no probability
+MASKED_LOGIT = -1e9
+
+
+def bucket_size(n, minimum=8):
+    """
+    Smallest bucket size of at least `n`, where bucket sizes are `minimum`,
+    its doublings, and one and a half times each of those, so that padding
+    to a bucket adds at most half again.
+
+    >>> [bucket_size(n) for n in [1, 8, 9, 13, 17, 90, 150]]
+    [8, 8, 12, 16, 24, 96, 192]
+    """
+    size = minimum
+    while size < n:
+        if size * 3 // 2 >= n:
+            return size * 3 // 2
+        size *= 2
+    return size
+
+
+def variant_slots(n_variants, max_variants):
+    """
+    Positions of a location's variants on a grid of `max_variants` variants.
+
+    The last variant, which the model takes as reference, goes in the last
+    slot so that references line up across locations, and any padding goes
+    just before it.
+    """
+    return np.append(np.arange(n_variants - 1), max_variants - 1)
+
+
+def pad_locations(datas, features=None, bucketed=False):
+    """
+    Stack the model inputs of several locations, padding variants and days.
+
+    `datas` are `ef.InnovationSequenceCounts`, one per location, and
+    `features` an optional list of their predictor matrices from
+    `make_features` for the predictor-informed model. Variants and days are
+    padded to the most of any location or, if `bucketed`, further up to
+    their `bucket_size`. Returns a dict of arrays with a leading location
+    axis, ready for `fit_map_batched`.
+    """
+    n_variants = [len(data.var_names) for data in datas]
+    n_days = [data.seq_counts.shape[0] for data in datas]
+    V, T = max(n_variants), max(n_days)
+    if bucketed:
+        V, T = bucket_size(V), bucket_size(T)
+
+    seq_counts = np.zeros((len(datas), T, V))
+    innovation_matrix = np.zeros((len(datas), V, V), dtype=bool)
+    variant_mask = np.zeros((len(datas), V), dtype=bool)
+    for i, data in enumerate(datas):
+        slots = variant_slots(n_variants[i], V)
+        seq_counts[i, : n_days[i], slots] = np.nan_to_num(data.seq_counts).T
+        innovation_matrix[i][np.ix_(slots, slots)] = data.innovation_matrix
+        variant_mask[i, slots] = True
+
+    t = np.arange(T)
+    stacked = {
+        "seq_counts": seq_counts,
+        "N": seq_counts.sum(axis=-1),
+        "X": np.broadcast_to(np.column_stack((np.ones(T), t)), (len(datas), T, 2)),
+        "innovation_matrix": innovation_matrix,
+        "variant_mask": variant_mask,
+    }
+
+    if features is not None:
+        n_features = features[0].shape[-1]
+        padded_features = np.zeros((len(datas), V - 1, n_features))
+        is_missing = np.zeros((len(datas), V - 1), dtype=bool)
+        for i, location_features in enumerate(features):
+            slots = variant_slots(n_variants[i], V)[:-1]
+            location_features = location_features[:-1]
+            missing = np.isnan(location_features).any(axis=1)
+            padded_features[i, slots] = np.nan_to_num(location_features)
+            is_missing[i, slots] = missing
+        stacked["features"] = padded_features
+        stacked["is_missing"] = is_missing
+
+    return {name: jnp.asarray(value) for name, value in stacked.items()}
+
+
+def masked_innovation_model(
+    seq_counts, N, X, innovation_matrix, variant_mask, features=None, is_missing=None
+):
+    """
+    `MLR_innovation_model` of evofr on padded inputs for one location.
+
+    Uses `DeltaNormalPrior` without `features` and `DeltaRegressionPrior`
+    with them. Priors of padded variants and the likelihood of padded
+    variants and days are masked out, so the objective equals that of the
+    unpadded model.
+    """
+    T, N_variants = seq_counts.shape
+    present = variant_mask[:-1]
+
+    raw_alpha = numpyro.sample(
+        "raw_alpha", dist.Normal(0.0, 3.0).expand([N_variants - 1]).mask(present)
+    )
+    raw_alpha = jnp.append(raw_alpha, jnp.zeros(1))
+
+    if features is None:
+        delta_scale = numpyro.sample("delta_scale", dist.HalfNormal(0.1))
+        delta_loc = numpyro.sample("delta_loc", dist.Normal(0.0, 0.1))
+        delta_loc = jnp.full(N_variants - 1, delta_loc)
+    else:
+        theta = numpyro.sample(
+            "theta", dist.Normal().expand([features.shape[-1]])
+        )
+        delta_loc_missing = numpyro.sample(
+            "delta_loc_missing",
+            dist.Normal(0.0, 3.0).expand([N_variants - 1]).mask(is_missing),
+        )
+        delta_loc = jnp.where(is_missing, delta_loc_missing, jnp.dot(features, theta))
+        delta_scale = numpyro.sample("delta_scale", dist.HalfNormal(0.1))
+
+    raw_delta = numpyro.sample(
+        "raw_delta", dist.Normal(delta_loc, delta_scale).mask(present)
+    )
+
+    pivot_delta = jnp.dot(raw_delta, innovation_matrix[-1, :-1])
+    delta = jnp.append(raw_delta, -pivot_delta)
+    raw_beta = jnp.dot(innovation_matrix, delta)
+    beta = jnp.column_stack((raw_alpha, raw_beta)).T
+
+    logits = jnp.where(variant_mask, jnp.dot(X, beta), MASKED_LOGIT)
+    numpyro.sample(
+        "seq_counts", dist.Multinomial(total_count=N, logits=logits), obs=seq_counts
+    )
+
+
+@functools.lru_cache
+def _map_optimizer(iters, lr, shapes):
+    """
+    SVI for `masked_innovation_model` and a jit-compiled run of `iters` of
+    its steps vectorized over locations, for stacked inputs of the given
+    `shapes`.
+
+    These are built once per setting and shapes, so that later fits of the
+    same shapes reuse the compiled run. The guide is not shared between
+    shapes, as it fixes the shapes of its parameters when first used.
+    """
+    guide = AutoDelta(masked_innovation_model)
+    svi = SVI(masked_innovation_model, guide, Adam(lr), Trace_ELBO())
+    update = jax.vmap(svi.stable_update)
+
+    @jax.jit
+    def run(state, stacked):
+        def step(state, _):
+            return update(state, **stacked)
+
+        return lax.scan(step, state, None, length=iters)
+
+    return svi, run
+
+
+def fit_map_batched(stacked, iters, lr, rng_key=None):
+    """
+    MAP estimates of `masked_innovation_model` for every location in `stacked`.
+
+    Returns a list with a dict of parameters for each location, keyed by
+    site name, and an array of losses of shape (locations, iters).
+    """
+    rng_key = random.PRNGKey(0) if rng_key is None else rng_key
+    shapes = tuple((name, value.shape) for name, value in sorted(stacked.items()))
+    svi, run = _map_optimizer(iters, lr, shapes)
+
+    n_locations = stacked["seq_counts"].shape[0]
+    location_inputs = [
+        {name: value[i] for name, value in stacked.items()} for i in range(n_locations)
+    ]
+    states = [svi.init(rng_key, **inputs) for inputs in location_inputs]
+    state = jax.tree.map(lambda *values: jnp.stack(values), *states)
+
+    state, losses = run(state, stacked)
+
+    params = []
+    for i in range(n_locations):
+        location_params = svi.get_params(jax.tree.map(lambda value: value[i], state))
+        params.append(
+            {name.removesuffix("_auto_loc"): value for name, value in location_params.items()}
+        )
+    return params, np.asarray(losses).T
+
+
+def location_samples(model, data, params, rng_key=None):
+    """
+    Posterior samples of one location from its batched MAP `params`, as
+    `ef.InferMAP` would return them for `model` and `data`.
+    """
+    rng_key = random.PRNGKey(0) if rng_key is None else rng_key
+    slots = variant_slots(len(data.var_names), len(params["raw_alpha"]) + 1)[:-1]
+
+    latents = {}
+    for name, value in params.items():
+        if name in {"raw_alpha", "raw_delta"}:
+            value = value[slots]
+        elif name == "delta_loc_missing":
+            value = value[slots][model.delta_prior.is_missing]
+        latents[name] = jnp.asarray(value)[None]
+
+    inputs = data.make_data_dict()
+    model.augment_data(inputs)
+    predictions = Predictive(model.model_fn, latents)(rng_key, pred=True, **inputs)
+    return {**latents, **predictions}
@@ -66,52 +66,59 @@
 import argparse
 
 import pandas as pd
-from pango_aliasor.aliasor import Aliasor
 
-
-def get_low_count_lineages(
-    seq_counts: pd.DataFrame, collapse_threshold: int, force_include: set
-) -> set:
-    total_counts = seq_counts.groupby("variant")["sequences"].sum()
-    low_count_lineages = set(
-        total_counts[total_counts < collapse_threshold].index.to_list()
-    )
-    low_count_lineages.discard("other")
-
-    # Exclude forece-included variants from collapsing
-    low_count_lineages -= force_include
-    return low_count_lineages
-
-
-def lineage_depth(lineage: str, aliasor: Aliasor) -> int:
-    return len(aliasor.uncompress(lineage).split("."))
+from lineage_hierarchy import LineageHierarchy
+from seq_counts_io import read_table, write_table
 
 
 def collapse_lineages(
-    seq_counts, collapse_threshold, aliasor: Aliasor, force_include: set
+    seq_counts, collapse_threshold, hierarchy: LineageHierarchy, force_include: set
 ):
-    print("Starting variants:", len(seq_counts.groupby("variant")))
-    print(seq_counts.variant.unique())
-
-    low_count_lineages = get_low_count_lineages(
-        seq_counts, collapse_threshold, force_include
+    variant = seq_counts["variant"].astype("category")
+    print("Starting variants:", len(variant.cat.categories))
+    print(variant.cat.categories.to_numpy())
+
+    # Work on the table of distinct variants: total counts, depth and parent are
+    # each computed once per lineage rather than per row or per depth level
+    totals = (
+        seq_counts.groupby(variant, observed=True)["sequences"].sum().to_dict()
     )
+    depths = {lineage: hierarchy.depth(lineage) for lineage in totals}
+    lineages_by_depth = {}
+    for lineage, depth in depths.items():
+        lineages_by_depth.setdefault(depth, []).append(lineage)
+
+    def is_low_count(lineage):
+        return (
+            totals[lineage] < collapse_threshold
+            and lineage != "other"
+            and lineage not in force_include
+        )
 
     # Find max depth of lineage tree
     max_lineage_depth = max(
-        map(lambda x: lineage_depth(x, aliasor), low_count_lineages)
+        (depths[lineage] for lineage in totals if is_low_count(lineage)), default=0
     )
 
-    # Collapse lineages from highest depth to lowest depth
+    # Collapse lineages from highest depth to lowest depth, rolling totals up
+    # into parents so that parents are judged on their collapsed counts
+    collapse_into = {}
     for depth in range(max_lineage_depth, 0, -1):
         low_count_lineages_at_depth = set()
-        for lineage in low_count_lineages:
-            if lineage_depth(lineage, aliasor) == depth:
-                low_count_lineages_at_depth.add(lineage)
-                parent = aliasor.parent(lineage)
-                if parent == "":
-                    parent = "other"
-                seq_counts.loc[seq_counts["variant"] == lineage, "variant"] = parent
+        for lineage in list(lineages_by_depth.get(depth, [])):
+            if not is_low_count(lineage):
+                continue
+            low_count_lineages_at_depth.add(lineage)
+            parent = hierarchy.parent(lineage)
+            if parent == "":
+                parent = "other"
+            if parent not in totals:
+                totals[parent] = 0
+                if parent != "other":
+                    depths[parent] = hierarchy.depth(parent)
+                    lineages_by_depth.setdefault(depths[parent], []).append(parent)
+            totals[parent] += totals.pop(lineage)
+            collapse_into[lineage] = parent
         print(
             "At depth",
             depth,
@@ -121,11 +128,17 @@ def collapse_lineages(
         )
         print(low_count_lineages_at_depth)
 
-        low_count_lineages = get_low_count_lineages(
-            seq_counts, collapse_threshold, force_include
-        )
+    # Follow each collapsed lineage up to the lineage it finally ends in and
+    # remap all rows at once through the categories
+    def collapsed_lineage(lineage):
+        while lineage in collapse_into:
+            lineage = collapse_into[lineage]
+        return lineage
+
+    collapsed_categories = variant.cat.categories.map(collapsed_lineage).to_numpy()
+    seq_counts["variant"] = collapsed_categories[variant.cat.codes.to_numpy()]
 
-    print("Ending variants:", len(seq_counts.groupby("variant")))
+    print("Ending variants:", len(totals))
     print(seq_counts.variant.unique())
 
     return seq_counts
@@ -142,7 +155,7 @@ def sort_output(seq_counts):
 
 
 def save_seq_counts(seq_counts, output_file):
-    seq_counts.to_csv(output_file, sep="\t", index=False)
+    write_table(seq_counts, output_file)
 
 
 def main():
@@ -152,7 +165,7 @@ def main():
         based on supplied threshold and output a new sequence counts file"
     )
     parser.add_argument(
-        "--seq-counts", type=str, required=True, help="input TSV of sequence counts"
+        "--seq-counts", type=str, required=True, help="input TSV, Parquet or Arrow file of sequence counts"
     )
     parser.add_argument(
         "--collapse-threshold",
@@ -164,7 +177,7 @@ def main():
         "--output-seq-counts",
         type=str,
         required=True,
-        help="output TSV of collapsed sequence counts",
+        help="output TSV, Parquet or Arrow file of collapsed sequence counts, by file extension",
     )
     parser.add_argument(
         "--force-include-file",
@@ -172,9 +185,19 @@ def main():
         required=False,
         help="file with list of variants to force include (one per line)",
     )
+    parser.add_argument(
+        "--alias-key",
+        type=str,
+        help="local copy of pango-designation alias_key.json, downloaded from github if not given",
+    )
+    parser.add_argument(
+        "--lineage-index",
+        type=str,
+        help="JSON index of resolved lineages to reuse across runs, updated at the end of the run",
+    )
     args = parser.parse_args()
 
-    seq_counts = pd.read_csv(args.seq_counts, sep="\t")
+    seq_counts = read_table(args.seq_counts)
 
     # Load force-included variants if provided
     force_include = set()
@@ -182,13 +205,15 @@ def main():
         with open(args.force_include_file, "r") as f:
             force_include = set(line.strip() for line in f)
 
-    # Automatically downloads aliasing file from github, needs internet connection
+    # Without --alias-key, downloads aliasing file from github, needs internet connection
     # File is sourced from https://github.com/cov-lineages/pango-designation/blob/master/pango_designation/alias_key.json
-    aliasor: Aliasor = Aliasor()
+    hierarchy = LineageHierarchy(args.alias_key, index_path=args.lineage_index)
 
     seq_counts = collapse_lineages(
-        seq_counts, args.collapse_threshold, aliasor, force_include
+        seq_counts, args.collapse_threshold, hierarchy, force_include
     )
+    if args.lineage_index:
+        hierarchy.save_index(args.lineage_index)
     seq_counts = aggregate_counts(seq_counts)
     seq_counts = sort_output(seq_counts)
 
@@ -1,57 +1,90 @@
 import argparse
 import collections
+import hashlib
 import json
+import os
+import numpy as np
 import pandas as pd
 import re
 
-def get_pango_mutations(pango_consensus_seqs_json, starting_clades):
+from seq_counts_io import read_table
+
+PangoIndex = collections.namedtuple("PangoIndex", ["clades", "parent", "children"])
+PangoIndex.__doc__ = """
+Pango consensus JSON parsed once, with `parent` and `children` adjacency dicts keyed by clade.
+"""
+
+
+def build_pango_index(pango_consensus_seqs_json):
     """
-    Retrieve mutations for each Pango lineage relative to parent.
+    Read Pango consensus sequences JSON into a reusable parent / child index.
     """
     with open(pango_consensus_seqs_json) as f:
         pango_clades = json.load(f)
+    return PangoIndex(
+        clades=pango_clades,
+        parent={c: d["parent"] for c, d in pango_clades.items()},
+        children={c: d["children"] for c, d in pango_clades.items()},
+    )
 
-    def _build_records(c, recs):
-        """
-        Build records of Pango clade information.
-        Recurses over children.
-        """
-        if c in recs["clade"]:
-            return
-        recs["clade"].append(c)
-        recs["date"].append(pango_clades[c]["designationDate"])
-        recs["parent"].append(pango_clades[c]["parent"])
-        recs["all_new_muts_from_ref"].append(
+
+def walk_pango_index(pango_index, starting_clades=None):
+    """
+    Yield clades descending from `starting_clades` in depth-first pre-order, each once.
+    If `starting_clades` is None, start from every clade without a parent in the index.
+    """
+    if starting_clades is None:
+        starting_clades = [
+            c for c, parent in pango_index.parent.items() if parent not in pango_index.clades
+        ]
+    visited = set()
+    stack = list(reversed(starting_clades))
+    while stack:
+        c = stack.pop()
+        if c in visited:
+            continue
+        visited.add(c)
+        yield c
+        stack.extend(reversed(pango_index.children[c]))
+
+
+def get_pango_mutations(pango_index, starting_clades=None, exclude_clades=(), only_clades=None):
+    """
+    Retrieve mutations for each Pango lineage relative to parent.
+    If `only_clades` is given, skip the other clades.
+    """
+    records = collections.defaultdict(list)
+    for c in walk_pango_index(pango_index, starting_clades):
+        if only_clades is not None and c not in only_clades:
+            continue
+        clade = pango_index.clades[c]
+        records["clade"].append(c)
+        records["date"].append(clade["designationDate"])
+        records["parent"].append(clade["parent"])
+        records["all_new_muts_from_ref"].append(
             [
                 mut
                 for field in ["aaSubstitutionsNew", "aaDeletionsNew"]
-                for mut in pango_clades[c][field]
+                for mut in clade[field]
                 if mut
             ]
         )
-        recs["all_new_muts_reverted_from_ref"].append(
+        records["all_new_muts_reverted_from_ref"].append(
             [
                 mut
                 for field in ["aaSubstitutionsReverted", "aaDeletionsReverted"]
-                for mut in pango_clades[c][field]
+                for mut in clade[field]
                 if mut
             ]
         )
-        recs["spike_muts_from_ref"].append(
+        records["spike_muts_from_ref"].append(
             [
                 mut.split(":")[1]
                 for field in ["aaSubstitutions", "aaDeletions"]
-                for mut in pango_clades[c][field]
+                for mut in clade[field]
                 if mut and mut.startswith("S:")
             ]
         )
-        for c_child in pango_clades[c]["children"]:
-            _build_records(c_child, recs)
-        return None
-            
-    records = collections.defaultdict(list)
-    for starting_clade in starting_clades:
-        _build_records(starting_clade, records)
 
     pango_df = pd.DataFrame(records).query("clade not in @exclude_clades")
     return pango_df
@@ -83,11 +116,18 @@ def consolidate_reversions(r):
         muts.append(f"{gene}:{new_wt}{site}{new_mutant}")
     return muts
         
-def get_pango_pair_differences(pango_df, pango_relationships_path, exclude_muts, pair_only_new_muts_are_spike):
-    # Alter parent name here with pango-variant relationships file for computing comparisons
-    pango_relationships = pd.read_csv(pango_relationships_path, sep="\t")
-    pango_relationships = pango_relationships.set_index("variant")
-    pango_df["parent"] = pango_df["variant"].map(lambda x: pango_relationships[x].parent)
+def read_closest_parents(pango_relationships_path, pango_index):
+    """
+    Parent of each clade for computing comparisons, from the pango-variant relationships file,
+    falling back to the consensus parent for clades not in the relationships file.
+    """
+    pango_relationships = read_table(pango_relationships_path, keep_default_na=False)
+    closest_parent = pango_relationships.set_index("variant")["closest_parent"].to_dict()
+    return {c: closest_parent.get(c, parent) for c, parent in pango_index.parent.items()}
+
+def get_pango_pair_differences(pango_df, closest_parent, exclude_muts, pair_only_new_muts_are_spike):
+    # Alter parent name here with closest parents from the pango-variant relationships file
+    pango_df = pango_df.assign(parent=lambda x: x["clade"].map(closest_parent))
 
     pango_pair_df = (
         pango_df
@@ -123,6 +163,104 @@ def get_pango_pair_differences(pango_df, pango_relationships_path, exclude_muts,
     pango_pair_df = pango_pair_df.drop(columns="only_new_muts_are_spike")
     return pango_pair_df
 
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY*-"
+
+# Code for any character not in AMINO_ACIDS, which never has DMS data
+UNKNOWN_AA = len(AMINO_ACIDS)
+
+_AA_CODES = np.full(256, UNKNOWN_AA, dtype=np.intp)
+_AA_CODES[np.frombuffer(AMINO_ACIDS.encode(), dtype=np.uint8)] = np.arange(len(AMINO_ACIDS))
+
+DMSArrays = collections.namedtuple(
+    "DMSArrays", ["min_site", "values", "measured", "wildtype", "region"]
+)
+DMSArrays.__doc__ = """
+DMS phenotypes as dense arrays indexed by site - `min_site` and amino-acid code.
+`values` is (sites, amino acids, phenotypes), zero at the wildtype and NaN where unmeasured.
+`measured` is (sites, amino acids), True where the summary has the mutation from the wildtype,
+whose values may still be NaN.
+`wildtype` is -1 at sites without DMS data, `region` is 1 for RBD, 0 for non-RBD, -1 if unknown.
+"""
+
+
+def compile_dms_summary(dms_summary, phenotypes_basic):
+    """
+    Compile DMS summary into dense arrays indexed by [site, amino-acid code].
+    """
+    sites = dms_summary["site"].astype(int).values
+    min_site = sites.min()
+    n_sites = sites.max() - min_site + 1
+    site_index = sites - min_site
+
+    wildtype = np.full(n_sites, -1, dtype=np.intp)
+    wildtype[site_index] = _AA_CODES[
+        np.frombuffer("".join(dms_summary["wildtype"]).encode(), dtype=np.uint8)
+    ]
+
+    mutant = _AA_CODES[np.frombuffer("".join(dms_summary["mutant"]).encode(), dtype=np.uint8)]
+    known = mutant != UNKNOWN_AA
+    values = np.full((n_sites, UNKNOWN_AA + 1, len(phenotypes_basic)), np.nan)
+    values[site_index[known], mutant[known]] = dms_summary[phenotypes_basic].astype(float).values[known]
+    measured = np.zeros((n_sites, UNKNOWN_AA + 1), dtype=bool)
+    measured[site_index[known], mutant[known]] = True
+    has_data = wildtype >= 0
+    values[has_data, wildtype[has_data]] = 0.0
+
+    region = np.full(n_sites, -1, dtype=np.int8)
+    if "region" in dms_summary.columns:
+        region[site_index] = (dms_summary["region"] == "RBD").astype(np.int8).values
+
+    return DMSArrays(min_site, values, measured, wildtype, region)
+
+
+def encode_mutations(muts, dms_arrays):
+    """
+    Encode mutations such as "K417N" as site index and parent and mutant amino-acid codes.
+    Sites outside the DMS site range have index -1.
+    """
+    sites = np.array([int(m[1: -1]) for m in muts], dtype=np.intp) - dms_arrays.min_site
+    site_index = np.where((sites >= 0) & (sites < len(dms_arrays.wildtype)), sites, -1)
+    parent = _AA_CODES[np.frombuffer("".join(m[0] for m in muts).encode(), dtype=np.uint8)]
+    mutant = _AA_CODES[np.frombuffer("".join(m[-1] for m in muts).encode(), dtype=np.uint8)]
+    return site_index, parent, mutant
+
+
+def mutation_effects(site_index, parent, mutant, dms_arrays):
+    """
+    DMS phenotypes of encoded mutations as an array of shape (mutations, phenotypes).
+
+    Phenotypes are measured relative to the DMS wildtype, so the effect of a
+    mutation is the phenotype of its mutant minus that of its parent. This
+    covers mutations from the wildtype, reversions to the wildtype, and
+    mutations between two non-wildtype amino acids. Effects are NaN where
+    either phenotype was not measured or the site has no DMS data.
+    """
+    site = np.maximum(site_index, 0)
+    effects = dms_arrays.values[site, mutant] - dms_arrays.values[site, parent]
+    effects[(site_index < 0) | (dms_arrays.wildtype[site] < 0)] = np.nan
+    return effects
+
+
+def mutations_measured(site_index, parent, mutant, dms_arrays):
+    """
+    Whether the DMS summary has the data needed for each encoded mutation:
+    the mutation from the wildtype to each of its parent and mutant amino
+    acids that is not the wildtype, at a site with DMS data. A mutation from
+    the wildtype to itself is not measured.
+    """
+    site = np.maximum(site_index, 0)
+    wildtype = dms_arrays.wildtype[site]
+    parent_is_wildtype = parent == wildtype
+    mutant_is_wildtype = mutant == wildtype
+    return (
+        (site_index >= 0)
+        & (wildtype >= 0)
+        & (parent_is_wildtype | dms_arrays.measured[site, parent])
+        & (mutant_is_wildtype | dms_arrays.measured[site, mutant])
+        & ~(parent_is_wildtype & mutant_is_wildtype)
+    )
+
+
 def process_dms_summary(input_path, split_by_rbd, missing_muts, rename_cols, phenotype_cols):
     """
     Read in dms summary to allow computation of dms phenotypes on sequences in future.
@@ -144,112 +282,140 @@ def process_dms_summary(input_path, split_by_rbd, missing_muts, rename_cols, phe
     else:
         raise ValueError(f"invalid {split_by_rbd=}")
 
-    # dict that maps site to wildtype in DMS
-    dms_wt = dms_summary.set_index("site")["wildtype"].to_dict()
+    if missing_muts not in {"drop", "zero"}:
+        raise ValueError(f"invalid {missing_muts=}")
+    if split_by_rbd and "region" not in dms_summary.columns:
+        raise ValueError(f"{split_by_rbd=} but 'region' not in {dms_summary.columns=}")
 
-    # dict that maps site to region in DMS
-    if "region" in dms_summary.columns:
-        site_to_region = dms_summary.set_index("site")["region"].to_dict()
-    else:
-        site_to_region = {}
+    dms_arrays = compile_dms_summary(dms_summary, phenotypes_basic)
+
+    def muts_dms(muts_lists, dms_arrays):
+        """
+        Get DMS phenotypes for a Series of mutation lists as a DataFrame with the same index.
+
+        All mutations are scored together in one long array and summed back to
+        their list with `numpy.add.at`, which (unlike a pandas groupby sum)
+        propagates the NaN of any unmeasured mutation to the list total.
+        """
+        n_muts = muts_lists.map(len).to_numpy(dtype=int)
+        row = np.repeat(np.arange(len(muts_lists)), n_muts)
+        site_index, parent, mutant = encode_mutations(
+            [m for ms in muts_lists for m in ms], dms_arrays
+        )
+        effects = mutation_effects(site_index, parent, mutant, dms_arrays)
+        # Mutations missing from the DMS summary are dropped or count as zero,
+        # while measured NaN values always propagate
+        measured = mutations_measured(site_index, parent, mutant, dms_arrays)
+        effects[~measured] = 0.0 if missing_muts == "zero" else np.nan
+
+        # group by (region, row), with non-RBD mutations after all RBD ones
+        n_rows = len(muts_lists)
+        n_parts = 2 if split_by_rbd else 1
+        group = row
         if split_by_rbd:
-            raise ValueError(f"{split_by_rbd=} but 'region' not in {dms_summary.columns=}")
-
-    # dicts that maps (site, wt, mutant) to DMS phenotypes for mutations
-    dms_data_all_dict = (
-        dms_summary
-        .set_index(["site", "wildtype", "mutant"])
-        [phenotypes_basic]
-        .to_dict(orient="index")
-    )
+            region = dms_arrays.region[np.maximum(site_index, 0)]
+            group = row + n_rows * (region != 1)
+            unknown = np.bincount(row, weights=(site_index < 0) | (region < 0), minlength=n_rows) > 0
+        sums = np.zeros((n_parts * n_rows, effects.shape[1]))
+        np.add.at(sums, group, effects)
+        scores = sums.reshape(n_parts, n_rows, effects.shape[1]).transpose(1, 0, 2).reshape(n_rows, len(phenotypes))
+        if split_by_rbd:
+            scores[unknown] = np.nan
+        return pd.DataFrame(scores, index=muts_lists.index, columns=phenotypes)
 
-    def mut_dms(m, dms_data_dict):
-        """Get DMS phenotypes for a mutation."""
-        if missing_muts == "drop":
-            null_d = {k: pd.NA for k in phenotypes_basic}
-        elif missing_muts == "zero":
-            null_d = {k: 0.0 for k in phenotypes_basic}
-        else:
-            raise ValueError(f"invalid {missing_muts=}")
-        site = int(m[1: -1])
-        if site not in dms_wt:
-            d = null_d
-        else:
-            parent = m[0]
-            mut = m[-1]
-            wt = dms_wt[site]
-            if parent == wt:
-                try:
-                    d = dms_data_dict[(site, parent, mut)]
-                except KeyError:
-                    d = null_d
-            elif mut == wt:
-                try:
-                    d = {k: -v for (k, v) in dms_data_dict[(site, mut, parent)].items()}
-                except KeyError:
-                    d = null_d
-            else:
-                try:
-                    parent_d = dms_data_dict[(site, wt, parent)]
-                    mut_d = dms_data_dict[(site, wt, mut)]
-                    d = {p: mut_d[p] - parent_d[p] for p in phenotypes_basic}
-                except KeyError:
-                    d = null_d
-        assert list(d) == phenotypes_basic
-        return d
-
-    def muts_dms(ms, dms_data_dict):
-        """Get DMS phenotypes for a list of mutations."""
-        muts_d = {k: 0 for k in phenotypes}
-        for m in ms:
-            if split_by_rbd:
-                try:
-                    is_rbd = site_to_region[int(m[1: -1])] == "RBD"
-                except KeyError:
-                    return {k: pd.NA for k in phenotypes}
-            m_d = mut_dms(m, dms_data_dict)
-            for k, val in m_d.items():
-                if split_by_rbd:
-                    if is_rbd:
-                        muts_d[f"{k} (RBD)"] += val
-                    else:
-                        muts_d[f"{k} (non-RBD)"] += val
-                else:
-                    muts_d[k] += val
-        return muts_d
-    return phenotypes, dms_data_all_dict, muts_dms
+    return phenotypes, dms_arrays, muts_dms
+
+
+def inputs_key(paths, config):
+    """
+    Hash of the input files at `paths` and the config.
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    h.update(json.dumps(config, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def clade_record_key(record, parent):
+    """
+    Hash of the consensus record of a clade, except its children, and its parent for comparisons.
+    """
+    record = {k: v for k, v in record.items() if k != "children"}
+    return hashlib.sha256(json.dumps([record, parent], sort_keys=True).encode()).hexdigest()
+
+
+def load_phenotype_cache(cache_path):
+    """
+    Load the cache of phenotype rows by clade from `cache_path`, or an empty cache if there is none yet.
+    """
+    if not os.path.exists(cache_path):
+        return {"inputs_key": None, "dms_key": None, "columns": None, "clades": {}}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def save_phenotype_cache(cache_path, cache):
+    """Write the cache of phenotype rows by clade to `cache_path`."""
+    with open(cache_path, "w") as f:
+        json.dump(cache, f)
+
+
+def update_phenotype_cache(cache, clades, clade_keys, clade_dms_df, pango_pair_dms_df):
+    """
+    Store the clade and clade pair phenotype rows of the clades just scored in `cache`,
+    and drop clades that are no longer in `clades`.
+    A row is None if the clade or clade pair was left out of the output.
+    """
+    clade_rows = clade_dms_df.set_index("clade", drop=False).to_dict("index")
+    pair_rows = pango_pair_dms_df.set_index("clade", drop=False).to_dict("index")
+    scored = {
+        c: {"key": clade_keys[c], "clade": clade_rows.get(c), "pair": pair_rows.get(c)}
+        for c in clade_keys
+    }
+    cache["clades"] = {c: scored.get(c, cache["clades"].get(c)) for c in clades}
+    cache["columns"] = {"clade": list(clade_dms_df.columns), "pair": list(pango_pair_dms_df.columns)}
+
+
+def write_cached_phenotypes(cache, clade_dms_path, pango_pair_dms_path):
+    """
+    Write the clade and clade pair phenotypes of all clades in `cache`.
+    """
+    for output, path in [("clade", clade_dms_path), ("pair", pango_pair_dms_path)]:
+        rows = [entry[output] for entry in cache["clades"].values() if entry[output] is not None]
+        df = pd.DataFrame(rows, columns=cache["columns"][output])
+        df.to_csv(path, float_format="%.5g", index=False, sep="\t")
+    print(f"Wrote phenotypes of {len(cache['clades'])} clades from the phenotype cache")
 
 
-def compute_dms_phenotype_pairs(pango_pair_df, dms_data_all_dict, phenotypes, muts_dms, pango_pair_dms_path):
+def compute_dms_phenotype_pairs(pango_pair_df, dms_arrays, phenotypes, muts_dms, pango_pair_dms_path):
     """
     Compute DMS phenotype for pango_pairs.
     """
 
     pango_pair_dms_df = (
         pango_pair_df
-        # to add multiple columns: https://stackoverflow.com/a/46814360
-        .apply(
-            lambda cols: pd.concat(
-                [cols, pd.Series(muts_dms(cols["spike_new_muts_list"], dms_data_all_dict))]
-            ),
-            axis=1,
-        )
+        .join(muts_dms(pango_pair_df["spike_new_muts_list"], dms_arrays))
         .drop(columns="spike_new_muts_list")
         # remove any clade pairs for which we don't have DMS data for all phenotypes
         .query(" and ".join(f"`{p}`.notnull()" for p in phenotypes))
         .reset_index(drop=True)
     )
 
-    pango_pair_dms_df.to_csv(pango_pair_dms_path, float_format="%.5g", index=False, sep="\t")
+    if pango_pair_dms_path is not None:
+        pango_pair_dms_df.to_csv(pango_pair_dms_path, float_format="%.5g", index=False, sep="\t")
     return pango_pair_dms_df
 
 def compute_dms_phenotype(
         pango_df: pd.DataFrame, 
         dms_clade: str,
-        dms_data_all_dict,
+        dms_arrays,
         phenotypes,
         muts_dms,
         exclude_muts,
+        exclude_clades=(),
         clade_dms_path: str | None =None,
         ) -> pd.DataFrame:
     """
@@ -300,21 +466,16 @@ def compute_dms_phenotype(
 
     clade_dms_df = (
         clade_df
-        # to add multiple columns: https://stackoverflow.com/a/46814360
-        .apply(
-            lambda cols: pd.concat(
-                [cols, pd.Series(muts_dms(cols["spike_muts_from_dms_clade_list"], dms_data_all_dict))]
-            ),
-            axis=1,
-        )
+        .join(muts_dms(clade_df["spike_muts_from_dms_clade_list"], dms_arrays))
         .drop(columns="spike_muts_from_dms_clade_list")
         # remove any clade pairs for which we don't have DMS data for all phenotypes
         .query(" and ".join(f"`{p}`.notnull()" for p in phenotypes))
         .reset_index(drop=True)
     )
 
-    print(f"Saving to {clade_dms_path}")
-    clade_dms_df.to_csv(clade_dms_path, float_format="%.5g", index=False, sep="\t")
+    if clade_dms_path is not None:
+        print(f"Saving to {clade_dms_path}")
+        clade_dms_df.to_csv(clade_dms_path, float_format="%.5g", index=False, sep="\t")
 
     print(f"Retained {len(clade_dms_df)} clades with growth and DMS data")
     return clade_dms_df
@@ -327,15 +488,57 @@ def main():
     parser.add_argument("--pango-relationships-path", type=str, required=True, help="Path to file containing pango-parent relationships.")
     parser.add_argument("--clade-pair-phenotype-path", type=str, required=True, help="Path to file containing clade pair phenotypes.")
     parser.add_argument("--config", type=str, required=True, help="Configuration file containing details for processing phenotypes")
+    parser.add_argument("--incremental-cache", type=str, help="Optional JSON cache of phenotypes by clade, reused across runs so only new or changed clades are recomputed. "
+                        "No workflow rule runs this script, as the workflow downloads precomputed phenotypes, so pass it when running the script directly, e.g. for a daily refresh.")
     args = parser.parse_args()
 
     config = json.loads(args.config)
 
-    # Add args for pango_consensus_json, starting_clades, .etc
-    pango_df = get_pango_mutations(pango_consensus_seqs_json=args.pango_consensus_seqs_json, starting_clades=None)
+    if args.incremental_cache:
+        cache = load_phenotype_cache(args.incremental_cache)
+        # Nothing to recompute if no input changed since the cache was written
+        run_inputs_key = inputs_key(
+            [args.pango_consensus_seqs_json, args.input_path, args.pango_relationships_path], config
+        )
+        if cache["inputs_key"] == run_inputs_key:
+            write_cached_phenotypes(cache, args.clade_phenotype_path, args.clade_pair_phenotype_path)
+            return None
+
+    # Parse the consensus JSON once and reuse its parent / child index below
+    pango_index = build_pango_index(args.pango_consensus_seqs_json)
+    closest_parent = read_closest_parents(args.pango_relationships_path, pango_index)
+
+    only_clades = None
+    if args.incremental_cache:
+        # Phenotypes of a clade only depend on its own consensus record and parent,
+        # given the DMS summary, the config and the mutations of the DMS clade
+        dms_key = inputs_key([args.input_path], {
+            "config": config,
+            "dms_clade": clade_record_key(pango_index.clades[config["dms-clade"]], None),
+        })
+        if cache["dms_key"] != dms_key and cache["clades"]:
+            print("DMS summary, config or DMS clade changed, recomputing all clades.")
+            cache["clades"] = {}
+        clades = [
+            c for c in walk_pango_index(pango_index, config.get("starting_clades"))
+            if c not in config.get("exclude_clades", [])
+        ]
+        clade_keys = {c: clade_record_key(pango_index.clades[c], closest_parent[c]) for c in clades}
+        only_clades = {c for c in clades if cache["clades"].get(c, {}).get("key") != clade_keys[c]}
+        print(f"Recomputing {len(only_clades)} of {len(clades)} clades not in phenotype cache")
+        # DMS clade mutations are needed to compute mutations of the other clades from it
+        only_clades.add(config["dms-clade"])
+        clade_keys = {c: clade_keys[c] for c in only_clades if c in clade_keys}
+
+    pango_df = get_pango_mutations(
+        pango_index,
+        starting_clades=config.get("starting_clades"),
+        exclude_clades=config.get("exclude_clades", []),
+        only_clades=only_clades,
+    )
 
     # Produce mapping to produce phenotypes from summary file
-    phenotypes, dms_data_all_dict, muts_dms = process_dms_summary(
+    phenotypes, dms_arrays, muts_dms = process_dms_summary(
         input_path=args.input_path,
         split_by_rbd=config["split_by_rbd"],
         missing_muts=config["missing_muts"],
@@ -343,31 +546,40 @@ def main():
         phenotype_cols=config["phenotype_cols"],
     )
 
-    # Map from reference sequences to DMS phenotype
-    compute_dms_phenotype(
+    # Map from reference sequences to DMS phenotype, writing outputs here
+    # unless they are merged with the phenotype cache below
+    clade_dms_df = compute_dms_phenotype(
         pango_df, 
         dms_clade=config["dms-clade"], 
-        dms_data_all_dict=dms_data_all_dict,
+        dms_arrays=dms_arrays,
         phenotypes=phenotypes,
         muts_dms=muts_dms,
         exclude_muts=config["exclude_muts"],
-        clade_dms_path=args.clade_phenotype_path,
+        exclude_clades=config.get("exclude_clades", []),
+        clade_dms_path=None if args.incremental_cache else args.clade_phenotype_path,
     )
 
     # Create pair dataframe using pango_df and pango_relationships
     pango_pair_df = get_pango_pair_differences(
         pango_df,
-        args.pango_relationships_path,
+        closest_parent,
         exclude_muts=config["exclude_muts"],
         pair_only_new_muts_are_spike=False,
     )
 
-    compute_dms_phenotype_pairs(
+    pango_pair_dms_df = compute_dms_phenotype_pairs(
         pango_pair_df, 
-        dms_data_all_dict=None, 
-        phenotypes=None, 
-        muts_dms=None, 
-        pango_pair_dms_path=None)
+        dms_arrays=dms_arrays, 
+        phenotypes=phenotypes, 
+        muts_dms=muts_dms, 
+        pango_pair_dms_path=None if args.incremental_cache else args.clade_pair_phenotype_path)
+
+    if args.incremental_cache:
+        update_phenotype_cache(cache, clades, clade_keys, clade_dms_df, pango_pair_dms_df)
+        cache["inputs_key"] = run_inputs_key
+        cache["dms_key"] = dms_key
+        write_cached_phenotypes(cache, args.clade_phenotype_path, args.clade_pair_phenotype_path)
+        save_phenotype_cache(args.incremental_cache, cache)
     return None
 
 if __name__ == "__main__":
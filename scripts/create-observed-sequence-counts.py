@@ -8,6 +8,8 @@ from datetime import datetime
 
 import pandas as pd
 
+from seq_counts_io import output_file, read_table, write_table
+
 
 def format_date(date_string, expected_format):
     """
@@ -105,12 +107,16 @@ if __name__ == "__main__":
         "--output-path",
         help="Path to output TSV for sequence counts by observation date.",
     )
+    parser.add_argument(
+        "--output-format",
+        choices=["tsv", "parquet", "arrow"],
+        default="tsv",
+        help="File format for output sequence counts.",
+    )
 
     args = parser.parse_args()
 
-    sequence_count_by_submission = pd.read_csv(
-        args.sequence_counts_by_submission, sep="\t"
-    )
+    sequence_count_by_submission = read_table(args.sequence_counts_by_submission)
 
     # We need to create a directory to hold observed counts
     observation_dates = pd.date_range(
@@ -145,8 +151,8 @@ if __name__ == "__main__":
             os.makedirs(path)
 
         # Make sure we have the folder
-        obs_seq.to_csv(
-            f"{path}/prepared_seq_counts_{obs_date}.tsv", sep="\t", index=False
+        write_table(
+            obs_seq, output_file(path, f"prepared_seq_counts_{obs_date}", args.output_format)
         )
 
     retrospective_seq_counts = observe_sequence_counts(
@@ -158,6 +164,7 @@ if __name__ == "__main__":
     if not os.path.exists(path):
         os.makedirs(path)
 
-    retrospective_seq_counts.to_csv(
-        f"{path}/seq_counts_retrospective.tsv", sep="\t", index=False
+    write_table(
+        retrospective_seq_counts,
+        output_file(path, "seq_counts_retrospective", args.output_format),
     )
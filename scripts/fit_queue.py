@@ -0,0 +1,243 @@
+"""
+Job queue directory for running model fits in a long-lived worker process.
+
+A worker (`run-innovation-model.py --serve-queue <queue>`) imports JAX and
+evofr once and then runs one fit after another, so each fit after the first
+skips the imports and reuses everything JAX has already compiled in that
+process. Jobs are the command-line arguments of the fitting script, submitted
+with
+
+    python scripts/fit_queue.py --queue <queue> -- <arguments>
+
+which waits for a worker to run the job, prints its output and exits with its
+exit code, so it can stand in for the fitting script in Snakemake rules.
+
+Each job is a file `<id>.json` in the queue directory. A worker claims a job
+by renaming it to `<id>.running`, which only one worker can do, writes the
+job's output to `<id>.log` and finally its exit code to `<id>.exit`. A
+submitter that stops waiting for a claimed job marks it `<id>.abandoned`, so
+the job's files are removed once it finishes. While
+running a job the worker touches `<id>.running` every HEARTBEAT_INTERVAL
+seconds, so a submitted job fails rather than waits forever if its worker
+dies. Any number of workers can serve the same queue. This module only uses
+the standard library, so submitting jobs does not import JAX.
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+POLL_INTERVAL = 0.5
+HEARTBEAT_INTERVAL = 5.0
+# Seconds without a heartbeat after which a running job's worker is presumed dead
+HEARTBEAT_TIMEOUT = 60.0
+
+
+def _job_path(queue_path, job_id, suffix):
+    return os.path.join(queue_path, job_id + suffix)
+
+
+def _write_atomically(path, text):
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+
+def _remove_job(queue_path, job_id):
+    for suffix in [".json", ".running", ".log", ".exit", ".abandoned"]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(_job_path(queue_path, job_id, suffix))
+
+
+def submit(queue_path, args, timeout=None):
+    """
+    Queue a job with command-line arguments `args`, run from the current
+    directory, and wait for a worker to finish it.
+
+    Prints the job's output and returns its exit code. Raises TimeoutError
+    if the job has not finished after `timeout` seconds, withdrawing it if
+    no worker has claimed it yet or else leaving the worker to remove it
+    when done, and RuntimeError if the worker running it stops sending
+    heartbeats.
+    """
+    os.makedirs(queue_path, exist_ok=True)
+    job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    job = {"args": list(args), "cwd": os.getcwd()}
+    _write_atomically(_job_path(queue_path, job_id, ".json"), json.dumps(job))
+
+    running_path = _job_path(queue_path, job_id, ".running")
+    exit_path = _job_path(queue_path, job_id, ".exit")
+    start = time.monotonic()
+    # Heartbeats are timed by when this process sees them change, not by the
+    # modification times themselves, so workers on other hosts may have other clocks
+    last_heartbeat, last_heartbeat_seen = None, start
+    while not os.path.exists(exit_path):
+        now = time.monotonic()
+        if timeout is not None and now - start > timeout:
+            try:
+                os.remove(_job_path(queue_path, job_id, ".json"))
+            except FileNotFoundError:
+                # claimed by a worker, which removes the job when it sees the mark,
+                # unless it finished before the mark was made
+                _write_atomically(_job_path(queue_path, job_id, ".abandoned"), "")
+                if os.path.exists(exit_path):
+                    _remove_job(queue_path, job_id)
+            raise TimeoutError(f"Job {job_id} did not finish within {timeout} seconds")
+        try:
+            heartbeat = os.stat(running_path).st_mtime_ns
+        except FileNotFoundError:
+            heartbeat = None
+        if heartbeat != last_heartbeat:
+            last_heartbeat, last_heartbeat_seen = heartbeat, now
+        elif heartbeat is not None and now - last_heartbeat_seen > HEARTBEAT_TIMEOUT:
+            if not os.path.exists(exit_path):
+                _remove_job(queue_path, job_id)
+                raise RuntimeError(
+                    f"Worker running job {job_id} sent no heartbeat for {HEARTBEAT_TIMEOUT} seconds"
+                )
+        time.sleep(POLL_INTERVAL)
+
+    with open(exit_path) as f:
+        exit_code = int(f.read())
+    with open(_job_path(queue_path, job_id, ".log")) as f:
+        sys.stdout.write(f.read())
+    for suffix in [".running", ".log", ".exit"]:
+        os.remove(_job_path(queue_path, job_id, suffix))
+    return exit_code
+
+
+def _claim_next_job(queue_path):
+    """
+    Claim the oldest unclaimed job in `queue_path`, returning its id and
+    contents, or None if there is none.
+    """
+    for path in sorted(glob.glob(os.path.join(queue_path, "*.json"))):
+        job_id = os.path.basename(path).removesuffix(".json")
+        running_path = _job_path(queue_path, job_id, ".running")
+        try:
+            os.rename(path, running_path)
+        except FileNotFoundError:
+            # another worker claimed it first
+            continue
+        # first heartbeat, as renaming keeps the time the job was submitted
+        os.utime(running_path)
+        with open(running_path) as f:
+            return job_id, json.load(f)
+    return None
+
+
+@contextlib.contextmanager
+def _heartbeat(running_path):
+    """
+    Touch `running_path` every HEARTBEAT_INTERVAL seconds from a background
+    thread, to show the job is still running.
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            # gone if the submitter already gave up on the job
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(running_path)
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _run_job(run, job, log):
+    """
+    Run `run(args)` for `job` from the job's directory, with its output going
+    to `log`, and return the exit code.
+    """
+    cwd = os.getcwd()
+    with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            os.chdir(job["cwd"])
+            run(job["args"])
+            return 0
+        except SystemExit as e:
+            # e.g. from argparse
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            print(e.code)
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            os.chdir(cwd)
+
+
+def serve(queue_path, run, idle_timeout=None):
+    """
+    Run the jobs submitted to `queue_path` one at a time with `run(args)`,
+    until no job has arrived for `idle_timeout` seconds, or indefinitely.
+    """
+    os.makedirs(queue_path, exist_ok=True)
+    print(f"Serving fits from {queue_path}", flush=True)
+    last_job = time.monotonic()
+    while idle_timeout is None or time.monotonic() - last_job < idle_timeout:
+        claimed = _claim_next_job(queue_path)
+        if claimed is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        job_id, job = claimed
+        print(f"Running job {job_id}", flush=True)
+        start = time.perf_counter()
+        with open(_job_path(queue_path, job_id, ".log"), "w") as log, _heartbeat(
+            _job_path(queue_path, job_id, ".running")
+        ):
+            exit_code = _run_job(run, job, log)
+        _write_atomically(_job_path(queue_path, job_id, ".exit"), str(exit_code))
+        if os.path.exists(_job_path(queue_path, job_id, ".abandoned")):
+            # nobody is waiting for the result
+            _remove_job(queue_path, job_id)
+        print(
+            f"Finished job {job_id} with exit code {exit_code} "
+            + f"in {time.perf_counter() - start:.1f} seconds",
+            flush=True,
+        )
+        last_job = time.monotonic()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Submit a fit to the workers serving a job queue directory and wait for it to finish."
+    )
+    parser.add_argument(
+        "--queue",
+        type=str,
+        required=True,
+        help="job queue directory served by one or more workers",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Seconds to wait for the job to finish before giving up.",
+    )
+    parser.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help="command-line arguments of the fit, after --",
+    )
+    args = parser.parse_args()
+
+    job_args = args.args[1:] if args.args[:1] == ["--"] else args.args
+    try:
+        sys.exit(submit(args.queue, job_args, timeout=args.timeout))
+    except (TimeoutError, RuntimeError) as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
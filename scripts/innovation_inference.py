@@ -0,0 +1,290 @@
+"""
+Inference of innovation models with warm starts and early stopping.
+
+`fit_map` and `fit_full_rank` follow `ef.InferMAP` and `ef.InferFullRank`,
+using the same guides, loss, optimizer and random keys, and return posteriors
+of the same form. They can also start the optimizer from given parameter
+values and stop once the loss has converged. `warm_start_values` derives such
+starting values from the posterior of a previous, overlapping window of data.
+`fit_nuts_from_map` samples with NUTS from the MAP estimate, and `fit`
+dispatches on a named inference method. `enable_compilation_cache` keeps
+compiled programs on disk for later processes.
+"""
+import os
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax import lax, random
+from numpyro.infer import SVI, Predictive, Trace_ELBO
+from numpyro.infer.autoguide import AutoDelta, AutoMultivariateNormal
+from numpyro.infer.initialization import init_to_value
+from numpyro.optim import Adam
+
+import evofr as ef
+
+# Number of optimizer steps between convergence checks
+CHECK_EVERY = 1_000
+
+
+class ConvergenceMonitor:
+    """
+    Decides when an optimization has converged from its losses, given in
+    blocks of steps.
+
+    The optimization has converged once the mean loss of a block changes by
+    less than `tolerance` relative to that of the block before. Without a
+    tolerance it never converges.
+    """
+
+    def __init__(self, tolerance=None):
+        self.tolerance = tolerance
+        self.previous_loss = None
+
+    def update(self, block_losses):
+        """
+        Record the losses of the latest block of steps and return whether
+        the optimization has converged.
+        """
+        mean_loss = float(jnp.mean(block_losses))
+        converged = (
+            self.tolerance is not None
+            and self.previous_loss is not None
+            and abs(self.previous_loss - mean_loss) <= self.tolerance * abs(self.previous_loss)
+        )
+        self.previous_loss = mean_loss
+        return converged
+
+
+def fit_svi(
+    model,
+    data,
+    guide_fn,
+    iters,
+    lr,
+    num_samples=1,
+    name="",
+    init_values=None,
+    tolerance=None,
+):
+    """
+    SVI fit of `model` to `data` with a guide of type `guide_fn` for at most
+    `iters` steps, as `ef.InferSVI`.
+
+    If `init_values` is given, the optimizer starts from those values of the
+    model's latent sites, and from the guide's default for any others. If
+    `tolerance` is given, the fit stops once a `ConvergenceMonitor` checking
+    every CHECK_EVERY steps reports convergence.
+
+    Returns the posterior, with `num_samples` samples, and the number of
+    steps run.
+    """
+    inputs = data.make_data_dict()
+    model.augment_data(inputs)
+
+    guide_options = {}
+    if init_values is not None:
+        guide_options["init_loc_fn"] = init_to_value(values=init_values)
+    guide = guide_fn(model.model_fn, **guide_options)
+    svi = SVI(model.model_fn, guide, Adam(lr), Trace_ELBO(num_particles=2))
+
+    rng_key = random.PRNGKey(0)
+    state = svi.init(rng_key, **inputs)
+
+    @jax.jit
+    def run_steps(state):
+        def step(state, _):
+            return svi.stable_update(state, **inputs)
+
+        return lax.scan(step, state, None, length=CHECK_EVERY)
+
+    run_step = jax.jit(lambda state: svi.stable_update(state, **inputs))
+
+    monitor = ConvergenceMonitor(tolerance)
+    losses = []
+    steps = 0
+    while steps < iters:
+        if iters - steps >= CHECK_EVERY:
+            state, chunk_losses = run_steps(state)
+        else:
+            # the last few steps, one at a time rather than compiling another scan
+            chunk_losses = []
+            for _ in range(iters - steps):
+                state, loss = run_step(state)
+                chunk_losses.append(loss)
+            chunk_losses = jnp.stack(chunk_losses)
+        losses.append(chunk_losses)
+        steps += len(chunk_losses)
+        if monitor.update(chunk_losses):
+            break
+
+    # Draw samples as SVIHandler.predict does
+    params = svi.get_params(state)
+    rng_key, guide_key = random.split(rng_key)
+    samples = Predictive(guide, params=params, num_samples=num_samples)(guide_key, **inputs)
+    rng_key, model_key = random.split(rng_key)
+    predictions = Predictive(model.model_fn, samples)(model_key, pred=True, **inputs)
+    samples = {**samples, **predictions}
+    samples["losses"] = jnp.concatenate(losses)
+
+    return ef.posterior.PosteriorHandler(samples=samples, data=data, name=name), steps
+
+
+def fit_map(model, data, iters, lr, name="", init_values=None, tolerance=None):
+    """
+    MAP fit of `model` to `data`, as `ef.InferMAP`. See `fit_svi`.
+    """
+    return fit_svi(
+        model, data, AutoDelta, iters, lr, name=name, init_values=init_values, tolerance=tolerance
+    )
+
+
+def fit_full_rank(
+    model, data, iters, lr, num_samples, name="", init_values=None, tolerance=None
+):
+    """
+    Full-rank multivariate normal fit of `model` to `data`, as
+    `ef.InferFullRank`. See `fit_svi`.
+    """
+    return fit_svi(
+        model,
+        data,
+        AutoMultivariateNormal,
+        iters,
+        lr,
+        num_samples=num_samples,
+        name=name,
+        init_values=init_values,
+        tolerance=tolerance,
+    )
+
+
+def fit_nuts_from_map(
+    model,
+    data,
+    iters,
+    lr,
+    num_warmup,
+    num_samples,
+    name="",
+    init_values=None,
+    tolerance=None,
+):
+    """
+    NUTS fit of `model` to `data`, started from its MAP estimate, as
+    `NUTS_from_MAP` in mlr-fitness/estimates/run-mlr-model.py.
+
+    `iters`, `lr`, `init_values` and `tolerance` apply to the MAP fit.
+    Returns the posterior and the number of MAP steps run.
+    """
+    MAP, steps = fit_map(
+        model, data, iters, lr, init_values=init_values, tolerance=tolerance
+    )
+    # Start sampling from the MAP estimate, as `ef.init_to_MAP` does
+    values = {
+        site: jnp.squeeze(value, axis=0) if value.shape[0] == 1 else value
+        for site, value in MAP.samples.items()
+    }
+    inference_method = ef.InferNUTS(
+        num_warmup=num_warmup,
+        num_samples=num_samples,
+        init_strategy=init_to_value(values=values),
+    )
+    return inference_method.fit(model, data, name=name), steps
+
+
+# Inference methods of `fit`, by the names used in run-mlr-model.py
+METHODS = {"MAP", "FullRank", "NUTS"}
+
+
+def fit(model, data, profile, name="", init_values=None):
+    """
+    Fit `model` to `data` as given by an inference `profile`, a dict with the
+    inference "method", one of METHODS, and its "iters", "lr", "num_samples",
+    "num_warmup" and "tolerance".
+
+    Returns the posterior and the number of optimizer steps run.
+    """
+    method = profile["method"]
+    options = {
+        "iters": profile["iters"],
+        "lr": profile["lr"],
+        "name": name,
+        "init_values": init_values,
+        "tolerance": profile["tolerance"],
+    }
+    if method == "MAP":
+        return fit_map(model, data, **options)
+    if method == "FullRank":
+        return fit_full_rank(model, data, num_samples=profile["num_samples"], **options)
+    if method == "NUTS":
+        return fit_nuts_from_map(
+            model,
+            data,
+            num_warmup=profile["num_warmup"],
+            num_samples=profile["num_samples"],
+            **options,
+        )
+    raise ValueError(f"Unknown inference method {method!r}, expected one of {sorted(METHODS)}")
+
+
+def enable_compilation_cache(path):
+    """
+    Keep the programs JAX compiles in `path`, so that later processes load
+    programs of the same structure and shapes rather than compiling them.
+
+    The cache is also set up through the environment, so worker processes
+    started from this one use it too.
+    """
+    os.makedirs(path, exist_ok=True)
+    os.environ["JAX_COMPILATION_CACHE_DIR"] = path
+    os.environ["JAX_PERSISTENT_CACHE_MIN_COMPILE_TIME_SECS"] = "0"
+    jax.config.update("jax_compilation_cache_dir", path)
+    # cache every program, as even quick compiles add up over many fits
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+
+
+def _closest_previous(variant, parent_map, previous_index):
+    """
+    Index in the previous fit of `variant` or, failing that, of its closest
+    ancestor in it, or None if it has none.
+    """
+    seen = set()
+    while isinstance(variant, str) and variant and variant not in seen:
+        if variant in previous_index:
+            return previous_index[variant]
+        seen.add(variant)
+        variant = parent_map.get(variant)
+    return None
+
+
+def warm_start_values(previous_samples, previous_data, data):
+    """
+    Initial values for a MAP fit to `data` from the MAP posterior of an
+    earlier window of data, `previous_samples` and `previous_data`.
+
+    Each variant's intercept and innovation are carried over from the
+    previous fit, with intercepts moved to the new first date. Variants that
+    have appeared since start from their closest ancestor in the previous
+    fit. The hyperparameters delta_loc, delta_scale and theta are copied, and
+    any other sites are left to the default initialization.
+    """
+    previous_index = {variant: i for i, variant in enumerate(previous_data.var_names)}
+    alpha, slope = np.asarray(previous_samples["beta"][0])
+    delta = np.asarray(previous_samples["delta"][0])
+    shift = (data.dates[0] - previous_data.dates[0]).days
+
+    raw_alpha = np.zeros(len(data.var_names) - 1)
+    raw_delta = np.zeros(len(data.var_names) - 1)
+    for i, variant in enumerate(data.var_names[:-1]):
+        j = _closest_previous(variant, data.parent_map, previous_index)
+        if j is not None:
+            raw_alpha[i] = alpha[j] + slope[j] * shift
+            raw_delta[i] = delta[j]
+
+    values = {"raw_alpha": jnp.asarray(raw_alpha), "raw_delta": jnp.asarray(raw_delta)}
+    for site in ["delta_loc", "delta_scale", "theta"]:
+        if site in previous_samples:
+            values[site] = jnp.asarray(previous_samples[site][0])
+    return values
+
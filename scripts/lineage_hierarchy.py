@@ -0,0 +1,141 @@
+"""
+Pango lineage hierarchy shared by the lineage scripts.
+
+Wraps `pango_aliasor.aliasor.Aliasor` loaded from a local alias key and
+memoizes the uncompressed name, parent and ancestors of every lineage it is
+asked about, so each lineage's string work is done once per run. The memoized
+lineages can be saved to a compact JSON index and reloaded on the next run.
+"""
+
+import hashlib
+import json
+import os
+
+from pango_aliasor.aliasor import Aliasor
+
+
+class LineageHierarchy:
+    """
+    Memoized Pango lineage hierarchy.
+
+    `alias_key` is the path to a local copy of pango-designation's
+    `alias_key.json`. If it is None, Aliasor downloads the current key from
+    GitHub, which needs an internet connection. If `index_path` names an index
+    previously written by `save_index` for the same alias key, its lineages are
+    loaded instead of being resolved again.
+
+    Also exposes `uncompress`, so it can be passed wherever an Aliasor is
+    expected for ordering or colouring lineages.
+    """
+
+    def __init__(self, alias_key=None, index_path=None):
+        self.aliasor = Aliasor(alias_key)
+        self.alias_key_hash = hashlib.sha256(
+            json.dumps(self.aliasor.alias_dict, sort_keys=True).encode()
+        ).hexdigest()
+        self._uncompressed = {}
+        self._parent = {}
+        self._ancestors = {}
+        if index_path is not None and os.path.exists(index_path):
+            self.load_index(index_path)
+
+    def uncompress(self, lineage):
+        """Fully uncompressed lineage name, e.g. B.1.1.529.5 for BA.5."""
+        try:
+            return self._uncompressed[lineage]
+        except KeyError:
+            uncompressed = self._uncompressed[lineage] = self.aliasor.uncompress(lineage)
+            return uncompressed
+
+    def depth(self, lineage):
+        """Number of levels in the uncompressed lineage name."""
+        return self.uncompress(lineage).count(".") + 1
+
+    def parent(self, lineage):
+        """Parent lineage in aliased format, or '' if `lineage` is at the top level."""
+        try:
+            return self._parent[lineage]
+        except KeyError:
+            parent = self._parent[lineage] = self.aliasor.parent(lineage)
+            return parent
+
+    def ancestors(self, lineage):
+        """Tuple of all ancestors of `lineage` in aliased format, nearest first."""
+        try:
+            return self._ancestors[lineage]
+        except KeyError:
+            pass
+        parent = self.parent(lineage)
+        ancestors = (parent,) + self.ancestors(parent) if parent else ()
+        self._ancestors[lineage] = ancestors
+        return ancestors
+
+    def closest_present_ancestor(self, variant, present):
+        """
+        Nearest ancestor of `variant` that is in the set `present`, or '' if none is.
+        """
+        for ancestor in self.ancestors(variant):
+            if ancestor in present:
+                return ancestor
+        return ""
+
+    def closest_present_ancestors(self, variants, present):
+        """
+        Dict mapping each of `variants` to its nearest ancestor in the set `present`, or ''.
+
+        Results are memoized for every ancestor passed through, so variants
+        sharing ancestors resolve each shared part of the tree only once.
+        """
+        closest = {}
+        for variant in variants:
+            # climb until reaching a present ancestor, the root, or a resolved ancestor
+            path = []
+            lineage = variant
+            while True:
+                parent = self.parent(lineage)
+                if parent in present or parent == "":
+                    found = parent
+                    break
+                if parent in closest:
+                    found = closest[parent]
+                    break
+                path.append(parent)
+                lineage = parent
+            for lineage in path:
+                closest[lineage] = found
+            closest[variant] = found
+        return {variant: closest[variant] for variant in variants}
+
+    def save_index(self, index_path):
+        """
+        Save memoized lineages to `index_path` as JSON mapping lineage to
+        [uncompressed name, parent], alongside a hash of the alias key.
+        """
+        lineages = {
+            lineage: [self.uncompress(lineage), self.parent(lineage)]
+            for lineage in self._uncompressed.keys() | self._parent.keys()
+        }
+        # keep lineages that parallel jobs sharing the index saved since it was loaded
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            if index["alias_key_hash"] == self.alias_key_hash:
+                lineages = {**index["lineages"], **lineages}
+        # write to a temporary file first, as parallel jobs may share one index
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"alias_key_hash": self.alias_key_hash, "lineages": lineages}, f)
+        os.replace(tmp_path, index_path)
+
+    def load_index(self, index_path):
+        """
+        Load lineages saved by `save_index`, ignoring an index built from a different alias key.
+        """
+        with open(index_path) as f:
+            index = json.load(f)
+        if index["alias_key_hash"] != self.alias_key_hash:
+            print(f"Ignoring lineage index {index_path} built from a different alias key.")
+            return
+        for lineage, (uncompressed, parent) in index["lineages"].items():
+            self._uncompressed[lineage] = uncompressed
+            self._parent[lineage] = parent
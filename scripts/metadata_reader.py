@@ -0,0 +1,126 @@
+"""
+Parallel reader for large line-oriented metadata TSVs.
+
+The file is decompressed in a separate process (`pigz`, `gzip`, `xz` or
+`zstd`), or in a background thread when none is installed. The decompressed
+stream is split into blocks of whole lines, and a function is mapped over the
+blocks in a process pool. Only the per-block results go back to the main
+process, so the pool can reduce each block to something small (e.g. partial
+counts) before returning it.
+
+Blocks are split on newlines, so fields must not contain embedded newlines,
+which holds for GISAID and Nextstrain metadata.
+"""
+import gzip
+import lzma
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+# Decompression commands to try in order, and the Python fallback for each extension
+DECOMPRESSORS = {
+    ".gz": (["pigz", "gzip"], gzip.open),
+    ".xz": (["xz"], lzma.open),
+    ".zst": (["zstd"], None),
+}
+
+
+@contextmanager
+def decompressed_stream(path):
+    """
+    Binary stream of the decompressed contents of `path`.
+
+    Decompression runs in a subprocess or a background thread, so it overlaps
+    with whatever the caller does with the stream. Raises RuntimeError if
+    decompression fails.
+    """
+    extension = os.path.splitext(path)[1]
+    if extension not in DECOMPRESSORS:
+        with open(path, "rb") as stream:
+            yield stream
+        return
+
+    commands, python_open = DECOMPRESSORS[extension]
+    command = next((command for command in commands if shutil.which(command)), None)
+
+    if command is not None:
+        process = subprocess.Popen([command, "-dc", path], stdout=subprocess.PIPE)
+        try:
+            yield process.stdout
+        except BaseException:
+            # the reader stopped early, so stop decompressing
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            raise RuntimeError(f"{command} failed to decompress {path} (exit code {returncode})")
+        return
+
+    if python_open is None:
+        raise RuntimeError(f"Cannot decompress {path}: none of {commands} is installed.")
+
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def decompress():
+        try:
+            with python_open(path, "rb") as source, os.fdopen(write_fd, "wb") as sink:
+                shutil.copyfileobj(source, sink, 1 << 20)
+        except BrokenPipeError:
+            # the reader stopped early
+            pass
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=decompress, daemon=True)
+    thread.start()
+    with os.fdopen(read_fd, "rb") as stream:
+        yield stream
+    thread.join()
+    if errors:
+        raise RuntimeError(f"Failed to decompress {path}: {errors[0]}")
+
+
+def line_blocks(path, block_size):
+    """
+    Yield (header, block) pairs for the TSV at `path`, where `header` is its
+    first line and each `block` holds about `block_size` bytes of whole lines
+    following it.
+    """
+    with decompressed_stream(path) as stream:
+        header = stream.readline()
+        while True:
+            block = stream.read(block_size)
+            if not block:
+                break
+            # extend the block to the end of its last line
+            if not block.endswith(b"\n"):
+                block += stream.readline()
+            yield header, block
+
+
+def map_blocks(path, function, processes, block_size):
+    """
+    Yield `function(header, block)` for every block of `path` from `line_blocks`,
+    in order, computed in a pool of `processes` processes.
+
+    At most two blocks per process are read ahead of the results, which bounds
+    memory use when the pool falls behind decompression. Pool processes are
+    spawned rather than forked, so they do not hold on to the decompression pipe.
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(processes, mp_context=context) as executor:
+        pending = deque()
+        for header, block in line_blocks(path, block_size):
+            pending.append(executor.submit(function, header, block))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -3,10 +3,14 @@ Summarize sequence counts grouped by date, location, and clade.
 """
 import argparse
 import os
+import shutil
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 
+from seq_counts_io import output_file, read_table, write_table
+
 
 def format_date(date_string, expected_format):
     """
@@ -80,6 +84,117 @@ def observe_sequence_counts(delayed, obs_date=None):
 BIAS_BUFFER = 14
 
 
+def window_bounds(obs_date, obs_date_min=None, num_days_context=None):
+    """
+    Return the exclusive min date and inclusive max date of the window observed on *obs_date*.
+    Either maintains a consistent window of *num_days_context* days or grows from *obs_date_min*,
+    and excludes the most recent days before *obs_date* due to bias.
+    """
+    if num_days_context is None:
+        min_date = obs_date_min
+    else:
+        min_date = pd.to_datetime(obs_date) - pd.Timedelta(
+            num_days_context + BIAS_BUFFER, "d"
+        )
+        min_date = min_date.strftime("%Y-%m-%d")
+    max_date = (pd.to_datetime(obs_date) - pd.Timedelta(BIAS_BUFFER, "d")).strftime(
+        "%Y-%m-%d"
+    )
+    return min_date, max_date
+
+
+def _day_ordinals(dates):
+    """
+    Convert ISO 8601 date strings to integer days since the epoch.
+
+    Returns the days and a boolean array of which dates are present, as
+    missing dates have no day.
+    """
+    codes, unique_dates = pd.factorize(dates)
+    unique_days = pd.to_datetime(unique_dates).values.astype("datetime64[D]").astype("int64")
+    # Missing dates have code -1, so give them a placeholder day at the end
+    unique_days = np.append(unique_days, 0)
+    return unique_days[codes], codes >= 0
+
+
+def observe_sequence_count_windows(delayed, obs_dates, obs_date_min=None, num_days_context=None):
+    """
+    Reconstruct the windowed sequence counts available on each of *obs_dates* in one pass.
+
+    Sequences are bucketed by the first observation date after their submission date,
+    summed per (location, variant, date) and bucket, and accumulated over buckets, so that
+    the counts observed on each date are the prefix sum up to its bucket. Yields
+    (obs_date, obs_seq) for each observation date in sorted order, with the same rows as
+    `observe_sequence_counts` followed by the window filters.
+    """
+    obs_dates = sorted(obs_dates)
+    obs_days, _ = _day_ordinals(pd.Series(obs_dates))
+
+    # Sorted codes so groups come out ordered by location, variant and date
+    location_codes, locations = pd.factorize(delayed["location"], sort=True)
+    variant_codes, variants = pd.factorize(delayed["variant"], sort=True)
+    days, has_date = _day_ordinals(delayed["date"])
+
+    # A sequence submitted on date_submitted is observed on every obs_date after it,
+    # so bucket it by the index of the first such obs_date
+    submitted_days, has_date_submitted = _day_ordinals(delayed["date_submitted"])
+    bucket = np.searchsorted(obs_days, submitted_days, side="right")
+    # Sequences missing either date, their location or their variant (code -1) are never
+    # observed, as the groupby in `observe_sequence_counts` drops them
+    observed = (
+        (bucket < len(obs_days)) & has_date & has_date_submitted &
+        (location_codes >= 0) & (variant_codes >= 0)
+    )
+
+    keys = ["location", "variant", "day"]
+    counts = (
+        pd.DataFrame({
+            "location": location_codes[observed],
+            "variant": variant_codes[observed],
+            "day": days[observed],
+            "bucket": bucket[observed],
+            "sequences": delayed["sequences"].to_numpy()[observed],
+        })
+        .groupby(keys + ["bucket"], as_index=False)["sequences"]
+        .sum()
+    )
+    counts["sequences"] = counts.groupby(keys)["sequences"].cumsum()
+
+    # Each row holds the count observed from its bucket until the next bucket of its group
+    location_codes = counts["location"].to_numpy()
+    variant_codes = counts["variant"].to_numpy()
+    days = counts["day"].to_numpy()
+    bucket = counts["bucket"].to_numpy()
+    sequences = counts["sequences"].to_numpy()
+    same_group_as_next = np.zeros(len(counts), dtype=bool)
+    same_group_as_next[:-1] = (
+        (location_codes[1:] == location_codes[:-1]) &
+        (variant_codes[1:] == variant_codes[:-1]) &
+        (days[1:] == days[:-1])
+    )
+    last_in_group = ~same_group_as_next
+    next_bucket = np.append(bucket[1:], len(obs_days))
+
+    for i, obs_date in enumerate(obs_dates):
+        min_date, max_date = window_bounds(obs_date, obs_date_min, num_days_context)
+        keep = (
+            (bucket <= i) &
+            (last_in_group | (next_bucket > i)) &
+            (sequences > 0) &
+            (days <= np.datetime64(max_date, "D").astype("int64"))
+        )
+        if min_date is not None:
+            keep &= days > np.datetime64(min_date, "D").astype("int64")
+
+        obs_seq = pd.DataFrame({
+            "date": days[keep].astype("datetime64[D]").astype(str),
+            "location": locations[location_codes[keep]],
+            "variant": variants[variant_codes[keep]],
+            "sequences": sequences[keep],
+        })
+        yield obs_date, obs_seq
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         __doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -87,10 +202,19 @@ if __name__ == "__main__":
     parser.add_argument(
         "--sequence-counts-by-submission",
         required=True,
-        help="Path to `sequence_counts_by_submission` TSV.",
+        help="Path to `sequence_counts_by_submission` TSV, Parquet or Arrow file.",
     )
     parser.add_argument("--obs-date", help="Observation date.")
     parser.add_argument("--obs-date-min", help="First date of observation.")
+    parser.add_argument(
+        "--obs-date-max",
+        help="Optionally, the last date of observation. If given, counts are observed "
+        + "on every date from `obs_date_min` to `obs_date_max` at `interval` in one pass, "
+        + "instead of only on `obs_date`.",
+    )
+    parser.add_argument(
+        "--interval", help="The interval for the date range e.g. '2W' or '1D'."
+    )
     parser.add_argument(
         "--num-days-context",
         type=int,
@@ -101,39 +225,48 @@ if __name__ == "__main__":
         "--output-path",
         help="Path to output TSV for sequence counts by observation date.",
     )
+    parser.add_argument(
+        "--output-format",
+        choices=["tsv", "parquet", "arrow"],
+        default="tsv",
+        help="File format for output sequence counts.",
+    )
+    parser.add_argument(
+        "--partitioned-output",
+        help="Optionally, path to also write all observation dates as one Parquet dataset partitioned by `obs_date`.",
+    )
 
     args = parser.parse_args()
 
-    sequence_count_by_submission = pd.read_csv(
-        args.sequence_counts_by_submission, sep="\t"
-    )
+    sequence_count_by_submission = read_table(args.sequence_counts_by_submission)
 
     print(args.num_days_context)
 
-    # Observe sequences up to this date
-    obs_date = args.obs_date
-    obs_seq = observe_sequence_counts(sequence_count_by_submission, obs_date=obs_date)
-
-    # Filter to appropriate date, either to maintain consistent window or grow window in time
-    if args.num_days_context is None:
-        min_date = args.obs_date_min
+    if args.obs_date_max is not None:
+        obs_dates = pd.date_range(
+            start=args.obs_date_min, end=args.obs_date_max, freq=args.interval
+        ).strftime("%Y-%m-%d").tolist()
     else:
-        min_date = pd.to_datetime(obs_date) - pd.Timedelta(
-            args.num_days_context + BIAS_BUFFER, "d"
-        )
-        min_date = min_date.strftime("%Y-%m-%d")
-    obs_seq = obs_seq[obs_seq.date > min_date]
+        obs_dates = [args.obs_date]
 
-    # Remove most recent 14 days due to bias
-    max_date = (pd.to_datetime(obs_date) - pd.Timedelta(BIAS_BUFFER, "d")).strftime(
-        "%Y-%m-%d"
-    )
-    obs_seq = obs_seq[obs_seq.date <= max_date]
-
-    # Export file
+    # Make sure we have the folder
     path = args.output_path
     if not os.path.exists(path):
         os.makedirs(path)
 
-    # Make sure we have the folder
-    obs_seq.to_csv(f"{path}/prepared_seq_counts_{obs_date}.tsv", sep="\t", index=False)
+    # Replace rather than append to any previous partitioned dataset
+    if args.partitioned_output and os.path.exists(args.partitioned_output):
+        shutil.rmtree(args.partitioned_output)
+
+    # Observe sequences up to each date, filtered to its window
+    for obs_date, obs_seq in observe_sequence_count_windows(
+        sequence_count_by_submission,
+        obs_dates,
+        obs_date_min=args.obs_date_min,
+        num_days_context=args.num_days_context,
+    ):
+        write_table(obs_seq, output_file(path, f"prepared_seq_counts_{obs_date}", args.output_format))
+        if args.partitioned_output:
+            obs_seq.assign(obs_date=obs_date).to_parquet(
+                args.partitioned_output, partition_cols=["obs_date"], index=False
+            )
@@ -0,0 +1,96 @@
+"""
+Summaries of innovation model posteriors as growth-advantage tables.
+
+The posterior samples of growth advantages and of their innovations are
+moved to the host once per posterior and summarized together with a single
+`np.quantile` call covering the median and the bounds of every credible
+interval, instead of pulling values off the device one variant at a time.
+"""
+import jax.numpy as jnp
+import numpy as np
+import pandas as pd
+
+
+def interval_levels(ps):
+    """
+    Quantile levels of the median followed by the lower and upper bounds of
+    the central credible interval for each coverage in `ps`.
+
+    >>> interval_levels([0.8])
+    [0.5, 0.09999999999999998, 0.9]
+    """
+    levels = [0.5]
+    for p in ps:
+        levels += [0.5 - p / 2, 0.5 + p / 2]
+    return levels
+
+
+def relative_to(values, var_names, rel_to):
+    """
+    `values` of shape (samples, variants) divided by the values of the
+    variant `rel_to`, or unchanged if `rel_to` is not among `var_names`.
+    """
+    if rel_to in var_names:
+        values = values / values[:, [var_names.index(rel_to)]]
+    return values
+
+
+def summarize(values, ps):
+    """
+    Median and credible interval bounds of each column of `values`, an array
+    of samples of shape (samples, variants), as a dict of columns named
+    "median" and "upper_{coverage}" and "lower_{coverage}" for each of `ps`.
+    """
+    # np.quantile works in float64, so return to the precision of the samples
+    quantiles = np.quantile(values, interval_levels(ps), axis=0).astype(values.dtype)
+    summary = {"median": quantiles[0]}
+    for i, p in enumerate(ps):
+        summary[f"upper_{round(p * 100)}"] = quantiles[2 + 2 * i]
+        summary[f"lower_{round(p * 100)}"] = quantiles[1 + 2 * i]
+    return summary
+
+
+def growth_advantage_tables(posterior, ps, rel_to):
+    """
+    Growth advantage and growth advantage delta tables of `posterior`,
+    relative to variant `rel_to`, with credible intervals for each coverage
+    in `ps`.
+
+    The tables have the same columns and rows as evofr's
+    `get_growth_advantage` and this repository's former
+    `get_growth_advantage_delta`: one row per variant other than `rel_to`.
+    """
+    var_names = list(posterior.data.var_names)
+    n_variants = len(var_names)
+
+    ga = np.asarray(posterior.samples["ga"])
+    ga = np.concatenate((ga, np.ones((ga.shape[0], 1), dtype=ga.dtype)), axis=1)
+    # exponentiate where the samples are, as evofr does, before moving them to the host
+    ga_delta = np.asarray(jnp.exp(posterior.samples["delta"]))
+
+    # Summarize both in one pass over the samples
+    values = np.concatenate(
+        (relative_to(ga, var_names, rel_to), relative_to(ga_delta, var_names, rel_to)),
+        axis=1,
+    )
+    summary = summarize(values, ps)
+
+    keep = np.array([variant != rel_to for variant in var_names])
+    variants = [variant for variant in var_names if variant != rel_to]
+    location = [posterior.name] * len(variants)
+
+    ga_df = pd.DataFrame({"location": location, "variant": variants})
+    ga_delta_df = pd.DataFrame(
+        {
+            "location": location,
+            "variant": variants,
+            "parent": [posterior.data.parent_map[variant] for variant in variants],
+        }
+    )
+    for statistic, column in summary.items():
+        name = "median_ga" if statistic == "median" else f"ga_{statistic}"
+        ga_df[name] = column[:n_variants][keep]
+        name = "median_ga_delta" if statistic == "median" else f"ga_delta_{statistic}"
+        ga_delta_df[name] = column[n_variants:][keep]
+
+    return ga_df, ga_delta_df
@@ -3,14 +3,20 @@ Prepare case counts and clade counts data for analysis by subsetting to
 specific date range and locations, pruning recent clade counts, and collapsing clades.
 """
 import argparse
+import numpy as np
 import pandas as pd
 import sys
 
 from datetime import datetime, timedelta
 
+from seq_counts_io import read_table, write_table
+
+# Locations, clades and dates are read as categoricals so every filter and
+# aggregation below runs over integer code arrays rather than strings
 SEQ_COUNTS_DTYPES = {
-    'location': 'string',
-    'clade': 'string',
+    'location': 'category',
+    'clade': 'category',
+    'date': 'category',
     'sequences': 'int64',
 }
 
@@ -32,12 +38,35 @@ def positive_int(value):
     return int_value
 
 
+def day_codes(dates):
+    """
+    Convert categorical date column to integer day offsets from the epoch,
+    with -1 for missing dates.
+    """
+    category_days = (
+        pd.to_datetime(dates.cat.categories).values.astype('datetime64[D]').astype('int64')
+    )
+    codes = dates.cat.codes.to_numpy()
+    return np.where(codes >= 0, category_days[codes], -1)
+
+
+def window_totals(codes, n_categories, days, sequences, min_day, max_day):
+    """
+    Sum sequences per category code over rows with days in [min_day, max_day].
+    Also returns whether each category has any rows in that window.
+    """
+    in_window = (codes >= 0) & (days >= min_day) & (days <= max_day)
+    totals = np.bincount(codes[in_window], weights=sequences[in_window], minlength=n_categories)
+    present = np.bincount(codes[in_window], minlength=n_categories) > 0
+    return totals.astype('int64'), present
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(__doc__,
         formatter_class=argparse.RawTextHelpFormatter)
 
     parser.add_argument("--seq-counts", metavar="TSV", required=True,
-        help="Path to clade counts TSV with four columns: 'location','clade','date','sequences'")
+        help="Path to clade counts TSV, Parquet or Arrow file with four columns: 'location','clade','date','sequences'")
     parser.add_argument("--min-date", default=DEFAULT_MIN_DATE,
         help="The minimum cutoff for date (inclusive), formatted as 'YYYY-MM-DD'.\n"
              "(default: %(default)s)")
@@ -66,7 +95,8 @@ if __name__ == '__main__':
     parser.add_argument("--force-exclude-clades", nargs="*",
         help="Clades to force exclude in the output regardless of sequences counts.")
     parser.add_argument("--output-seq-counts", required=True,
-        help="Path to output TSV file for the prepared variants data.")
+        help="Path to output TSV, Parquet or Arrow file for the prepared variants data,\n"
+             "with the format chosen from the file extension.")
 
     args = parser.parse_args()
 
@@ -83,8 +113,22 @@ if __name__ == '__main__':
     ###########################################################################
     ################### Rules for subsetting by location ######################
     ###########################################################################
-    # Load entire clade counts data since we need to to find all locations
-    seq_counts = pd.read_csv(args.seq_counts, sep='\t', parse_dates=['date'], dtype=SEQ_COUNTS_DTYPES)
+    # Load only the needed columns, keeping integer codes for location, clade and date
+    seq_counts = read_table(
+        args.seq_counts,
+        usecols=list(SEQ_COUNTS_DTYPES),
+        dtype=SEQ_COUNTS_DTYPES,
+    )
+    location_names = seq_counts['location'].cat.categories
+    location_codes = seq_counts['location'].cat.codes.to_numpy()
+    clade_names = seq_counts['clade'].cat.categories
+    clade_codes = seq_counts['clade'].cat.codes.to_numpy()
+    days = day_codes(seq_counts['date'])
+    sequences = seq_counts['sequences'].to_numpy()
+    del seq_counts
+
+    min_day = np.datetime64(min_date, 'D').astype('int64')
+    max_day = np.datetime64(max_date, 'D').astype('int64')
 
     # Set the min_date as the default min date for counting sequences per location
     # to count sequences per location over the entire analysis date range
@@ -103,14 +147,15 @@ if __name__ == '__main__':
             "in the analysis date range."
         )
 
-    # Subset to locations and sequences within the date range from min_location_seq_date to max_date
-    # and group by location to get the total number of sequences per location in this date range
-    location_and_seqs = seq_counts.loc[
-        (seq_counts['date'] >= min_location_seq_date if min_location_seq_date else True) &
-        (seq_counts['date'] <= max_date),
-        ['location', 'sequences']
-    ]
-    seqs_per_location = location_and_seqs.groupby(['location'], as_index=False).sum()
+    # Total number of sequences per location in the date range from min_location_seq_date to max_date
+    seqs_per_location, location_in_window = window_totals(
+        location_codes, len(location_names), days, sequences,
+        np.datetime64(min_location_seq_date, 'D').astype('int64'), max_day,
+    )
+    seqs_per_location = pd.DataFrame({
+        'location': location_names[location_in_window],
+        'sequences': seqs_per_location[location_in_window],
+    })
 
     # Get a set of locations that meet the location_min_seq requirement
     locations_with_min_seq = set(seqs_per_location.loc[seqs_per_location['sequences'] >= args.location_min_seq, 'location'])
@@ -135,9 +180,6 @@ if __name__ == '__main__':
     ############## Rules for collapsing clades to variants ####################
     ###########################################################################
 
-    # Duplicate 'clade' column to 'variant' column to faciliate mapping to 'other'
-    seq_counts['variant'] = seq_counts.loc[:, 'clade']
-
     # Keep track of clades that are force included so that they can bypass the sequence counts check
     force_included_clades = set()
     if args.force_include_clades:
@@ -173,52 +215,62 @@ if __name__ == '__main__':
                 "in the analysis date range (inclusive) into a single 'other' variant."
             )
 
-        # Subset to clades and sequences within the date range from min_clades_seq_date to max_date
-        # and group by clade to get the total number of sequences per clade in this date range
-        clades_and_seqs = seq_counts.loc[
-            (seq_counts['date'] >= min_clades_seq_date if min_clades_seq_date else True) &
-            (seq_counts['date'] <= max_date),
-            ['clade', 'sequences']
-        ]
-        seqs_per_clade = clades_and_seqs.groupby(['clade'], as_index=False).sum()
+        # Total number of sequences per clade in the date range from min_clades_seq_date to max_date
+        seqs_per_clade, _ = window_totals(
+            clade_codes, len(clade_names), days, sequences,
+            np.datetime64(min_clades_seq_date, 'D').astype('int64'), max_day,
+        )
 
         # Get a set of clades that meet the clade_min_seq requirement
-        clades_with_min_seq = set(seqs_per_clade.loc[seqs_per_clade['sequences'] >= args.clade_min_seq, 'clade'])
+        clades_with_min_seq = set(clade_names[seqs_per_clade >= args.clade_min_seq])
 
         # Remove force excluded clades from this list
         clades_to_keep = clades_with_min_seq - force_excluded_clades
 
         # Replace variant with 'other' if they are not force included and do not meet the clade_min_seq requirement
-        seq_counts.loc[~seq_counts['clade'].isin(force_included_clades | clades_to_keep), 'variant'] = 'other'
+        keep_clade = clade_names.isin(force_included_clades | clades_to_keep)
+    else:
+        keep_clade = np.ones(len(clade_names), dtype=bool)
 
     # Replace 'recombinant' clade with 'other'
-    seq_counts.loc[seq_counts['clade'].isin(['recombinant']), 'variant'] = 'other'
-
-    # Add clades with unknown variants to 'other' variant group
-    seq_counts.loc[pd.isna(seq_counts['variant']), 'variant'] = 'other'
-
-    # Collapse the variants of the same location and date
-    seq_counts = seq_counts.groupby(['location', 'variant', 'date'], as_index=False).sum(numeric_only=False)
-    seq_counts.drop(columns=['clade'], inplace=True)
+    keep_clade &= ~clade_names.isin(['recombinant'])
 
+    # Map clade codes to sorted variant codes, with clades with unknown variants in the 'other' variant group
+    variant_of_clade = np.append(np.where(keep_clade, clade_names, 'other'), 'other')
+    variant_of_clade_codes, variant_names = pd.factorize(variant_of_clade, sort=True)
+    variant_codes = variant_of_clade_codes[clade_codes]
 
     ###########################################################################
     ##################### Rules for pruning sequence counts ###################
     ###########################################################################
 
     # The default max date for clade counts is the max date
-    max_clade_date = max_date
+    max_clade_day = max_day
 
     ###########################################################################
     ########################## Subset and output data #########################
     ###########################################################################
 
-    # Subset the clade counts data by date and locations
-    seq_counts = seq_counts.loc[
-        (seq_counts['date'] >= min_date if min_date else True) &
-        (seq_counts['date'] <= max_clade_date) &
-        (seq_counts['location'].isin(locations_to_include))
-    ]
+    # Subset the clade counts data by date and locations as a mask over the code arrays,
+    # dropping rows with a missing location or date as the groupby previously did
+    include_location = location_names.isin(locations_to_include)
+    keep = (
+        (location_codes >= 0) &
+        (days >= min_day) &
+        (days <= max_clade_day) &
+        include_location[location_codes]
+    )
+
+    # Collapse the variants of the same location and date, sorted by location, variant and date
+    seq_counts = pd.DataFrame({
+        'location': location_codes[keep],
+        'variant': variant_codes[keep],
+        'date': days[keep],
+        'sequences': sequences[keep],
+    }).groupby(['location', 'variant', 'date'], as_index=False)['sequences'].sum()
+    seq_counts['location'] = location_names[seq_counts['location']]
+    seq_counts['variant'] = variant_names[seq_counts['variant']]
+    seq_counts['date'] = seq_counts['date'].to_numpy().astype('datetime64[D]').astype(str)
 
     included_variants = seq_counts['variant'].unique()
     print(f"Variants that will be included: {sorted(included_variants)}.")
@@ -226,10 +278,5 @@ if __name__ == '__main__':
     assert len(included_variants) > 0, \
         "All variants have been excluded. Try again with different options, e.g. lowering the `--clade-min-seq` cutoff."
 
-    # Sort variants subset and print to output file
-    seq_counts.sort_values(['location', 'variant', 'date']) \
-          .to_csv(
-              args.output_seq_counts,
-              sep='\t',
-              index=False,
-          )
+    # Print sorted variants subset to output file
+    write_table(seq_counts, args.output_seq_counts)
@@ -1,32 +1,35 @@
 import argparse
 import pandas as pd
-from pango_aliasor.aliasor import Aliasor
+from lineage_hierarchy import LineageHierarchy
+from seq_counts_io import read_table, write_table
 
-def find_closest_parents(variant: str, variants: list[str], aliasor: Aliasor):
-    parent = aliasor.parent(variant)
-    while parent != "":
-        if parent in variants:
-            return parent
-        parent = aliasor.parent(parent)
-    return parent
+def find_closest_parents(variants: list[str], hierarchy: LineageHierarchy) -> dict[str, str]:
+    """Map each variant to its closest ancestor among `variants`, or '' if it has none."""
+    return hierarchy.closest_present_ancestors(variants, set(variants))
 
 def main():
     parser = argparse.ArgumentParser(description = "Given input sequence counts, generate a file mapping lineages to closest parental lineage.")
-    parser.add_argument("--seq-counts", type=str, required=True, help="input TSV of collapsed sequence counts")
-    parser.add_argument("--output-relationships", type=str, required=True, help="output TSV of pango-variant-relationships")
+    parser.add_argument("--seq-counts", type=str, required=True, help="input TSV, Parquet or Arrow file of collapsed sequence counts")
+    parser.add_argument("--output-relationships", type=str, required=True, help="output TSV, Parquet or Arrow file of pango-variant-relationships, by file extension")
+    parser.add_argument("--alias-key", type=str, help="local copy of pango-designation alias_key.json, downloaded from github if not given")
+    parser.add_argument("--lineage-index", type=str, help="JSON index of resolved lineages to reuse across runs, updated at the end of the run")
     args = parser.parse_args()
 
-    aliasor = Aliasor()
-    seq_counts = pd.read_csv(args.seq_counts, sep="\t")
-    variants = seq_counts.variant.unique()
+    hierarchy = LineageHierarchy(args.alias_key, index_path=args.lineage_index)
+    # Only the distinct variant names are needed, so read just that column as categorical
+    seq_counts = read_table(
+        args.seq_counts, usecols=["variant"], dtype={"variant": "category"}
+    )
+    variants = seq_counts.variant.unique().tolist()
 
-    parent_map = []
-    for variant in variants:
-        closest_parent = find_closest_parents(variant, variants, aliasor)
-        parent_map.append({"variant": variant, "closest_parent": closest_parent})
+    closest_parents = find_closest_parents(variants, hierarchy)
+    variant_relationships = pd.DataFrame(
+        {"variant": variants, "closest_parent": [closest_parents[v] for v in variants]}
+    )
+    write_table(variant_relationships, args.output_relationships)
 
-    variant_relationships = pd.DataFrame(parent_map)
-    variant_relationships.to_csv(args.output_relationships, sep="\t", index=False)
+    if args.lineage_index:
+        hierarchy.save_index(args.lineage_index)
 
 if __name__ == "__main__":
     main()
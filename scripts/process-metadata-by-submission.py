@@ -2,12 +2,18 @@
 Summarize sequence counts grouped by date, submission_date, location, and clade.
 """
 import argparse
+import io
 import os
 import sys
-from datetime import datetime
+from datetime import date, datetime
+from functools import partial
 
+import numpy as np
 import pandas as pd
 
+from metadata_reader import map_blocks
+from seq_counts_io import output_file, write_table
+
 
 def format_date(date_string, expected_format):
     """
@@ -32,12 +38,114 @@ def format_date(date_string, expected_format):
         return None
 
 
-def count_sequences_with_submission_date(metadata):
-    grouped = metadata.groupby(["date", "location", "variant", "date_submitted"])
-    counts = grouped.size().reset_index(name="sequences")
+def day_ordinals(dates, known_dates):
+    """
+    Integer day ordinals of the ISO 8601 date strings in *dates*, or -1 for
+    missing or incorrectly formatted dates.
+
+    Each distinct string is parsed once and remembered in the dict
+    *known_dates*, so dates repeated across chunks are not parsed again.
+    """
+    codes, uniques = pd.factorize(dates)
+    for date_string in uniques:
+        if date_string not in known_dates:
+            formatted = format_date(date_string, "%Y-%m-%d")
+            known_dates[date_string] = (
+                date.fromisoformat(formatted).toordinal() if formatted else -1
+            )
+    # Missing values have code -1 and so pick up the trailing -1
+    ordinals = np.array([known_dates[d] for d in uniques] + [-1], dtype=np.int64)
+    return ordinals[codes]
+
+
+class FilterQueryError(Exception):
+    """Raised when the filter query cannot be applied to the metadata."""
+
+
+def filter_metadata(metadata, filter_query, column_map):
+    """
+    Apply *filter_query* to a metadata chunk if given, then subset and rename
+    its columns according to *column_map*.
+    """
+    # If provided filter query, apply query then subset to required columns
+    if filter_query:
+        try:
+            metadata.query(filter_query, inplace=True)
+        except Exception as e:
+            raise FilterQueryError(str(e)) from e
+
+        metadata = metadata[column_map.keys()]
+
+    # Rename columns to output column names
+    return metadata.rename(columns=column_map)
+
+
+def count_chunk(metadata, known_dates, min_day, max_day):
+    """
+    Partial sequence counts of one metadata chunk, indexed by
+    (date, location, variant, date_submitted) with dates as day ordinals.
+
+    Drops sequences with a missing or incorrectly formatted date or
+    submission date, a date outside [*min_day*, *max_day*], or a missing
+    location or variant.
+    """
+    location_codes, locations = pd.factorize(metadata["location"])
+    variant_codes, variants = pd.factorize(metadata["variant"])
+    keys = pd.DataFrame(
+        {
+            "date": day_ordinals(metadata["date"], known_dates),
+            "location": location_codes,
+            "variant": variant_codes,
+            "date_submitted": day_ordinals(metadata["date_submitted"], known_dates),
+        }
+    )
+    keep = (
+        (keys["date"] >= min_day)
+        & (keys["date"] <= max_day)
+        & (keys["location"] >= 0)
+        & (keys["variant"] >= 0)
+        & (keys["date_submitted"] >= 0)
+    )
+    counts = keys[keep].groupby(list(keys.columns)).size()
+
+    # Replace location and variant codes by names, which are the same across chunks
+    index = counts.index
+    counts.index = index.set_levels(
+        [locations[index.levels[1]], variants[index.levels[2]]], level=[1, 2]
+    )
     return counts
 
 
+# Dates parsed by this process, shared by the blocks a pool process counts
+_known_dates = {}
+
+
+def count_block(header, block, usecols, filter_query, column_map, min_day, max_day):
+    """
+    Partial sequence counts, as for `count_chunk`, of a block of metadata
+    lines from `metadata_reader.line_blocks`.
+    """
+    metadata = pd.read_csv(
+        io.BytesIO(header + block), sep="\t", usecols=usecols, dtype="object"
+    )
+    metadata = filter_metadata(metadata, filter_query, column_map)
+    return count_chunk(metadata, _known_dates, min_day, max_day)
+
+
+def decode_counts(counts):
+    """
+    Turn sequence counts keyed on day ordinals back into a table of
+    date, location, variant, date_submitted and sequences.
+    """
+    counts = counts.astype(np.int64).reset_index(name="sequences")
+    for column in ["date", "date_submitted"]:
+        codes, uniques = pd.factorize(counts[column])
+        dates = np.array([date.fromordinal(int(day)).isoformat() for day in uniques], dtype=object)
+        counts[column] = dates[codes]
+    counts = counts.sort_values(["date", "location", "variant", "date_submitted"])
+    return counts.reset_index(drop=True)
+
+
 BIAS_BUFFER = 14
 
 if __name__ == "__main__":
@@ -93,6 +201,22 @@ if __name__ == "__main__":
         help="Maximum metadata records to read into memory at once during initial pass."
         + "Increasing this value increases peak memory usage.",
     )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of processes used to parse, filter and count local metadata. "
+        + "With more than one, the metadata is decompressed in a separate process "
+        + "and split into blocks of lines that are counted in parallel.",
+    )
+    parser.add_argument(
+        "--metadata-block-size",
+        type=int,
+        default=64_000_000,
+        help="Approximate number of decompressed bytes of metadata in each block "
+        + "counted in parallel when using more than one thread. "
+        + "Increasing this value increases peak memory usage per thread.",
+    )
     parser.add_argument("--obs-date-min", help="First date of observation.")
     parser.add_argument("--obs-date-max", help="Last date of observation.")
     parser.add_argument(
@@ -105,6 +229,12 @@ if __name__ == "__main__":
         "--output-path",
         help="Path to output TSV for sequence counts by observation date.",
     )
+    parser.add_argument(
+        "--output-format",
+        choices=["tsv", "parquet", "arrow"],
+        default="tsv",
+        help="File format for output sequence counts.",
+    )
 
     args = parser.parse_args()
 
@@ -129,75 +259,75 @@ if __name__ == "__main__":
     if args.filter_columns:
         metadata_usecols.update(args.filter_columns)
 
-    # Load metadata TSV.
-    metadata_reader = pd.read_csv(
-        args.metadata,
-        sep="\t",
-        usecols=list(metadata_usecols),
-        dtype="object",
-        chunksize=args.metadata_chunk_size,
-    )
-
-    # Iterate through metadata in chunks to control peak memory usage.
-    print("Chunking")
-    metadata_chunks = []
-    for metadata in metadata_reader:
-        # If provided filter query, apply query then subset to required columns
-        if args.filter_query:
-            try:
-                metadata.query(args.filter_query, inplace=True)
-            except Exception as e:
-                print(
-                    "ERROR: An error occurred when applying the filter query. "
-                    "Most likely the filter query used columns that were not included in the filter columns. "
-                    f"See detailed error: ({e})",
-                    file=sys.stderr,
-                )
-                sys.exit(1)
-
-            metadata = metadata[metadata_column_map.keys()]
-
-        # Rename columns to output column names
-        metadata.rename(columns=metadata_column_map, inplace=True)
-
-        # Convert location and clade columns to category dtype
-        metadata["location"] = metadata["location"].astype("category")
-        metadata["variant"] = metadata["variant"].astype("category")
-
-        # Convert date column to datetime, sets ambiguous dates to None
-        metadata["date"] = pd.to_datetime(metadata["date"], errors="coerce")
-        metadata.dropna(subset=["date"], inplace=True)
-
-        # Filter to time period
-        min_date = pd.Timestamp(args.obs_date_min) - pd.Timedelta(
-            days=args.num_days_context + BIAS_BUFFER
-        )
-        max_date = pd.Timestamp(args.obs_date_max)
-        metadata = metadata[(metadata.date >= min_date) & (metadata.date <= max_date)]
-        metadata["date"] = pd.to_datetime(metadata["date"]).dt.strftime("%Y-%m-%d")
-        metadata["date_submitted"] = pd.to_datetime(
-            metadata["date_submitted"]
-        ).dt.strftime("%Y-%m-%d")
+    # Filter to time period
+    min_day = (
+        pd.Timestamp(args.obs_date_min)
+        - pd.Timedelta(days=args.num_days_context + BIAS_BUFFER)
+    ).toordinal()
+    max_day = pd.Timestamp(args.obs_date_max).toordinal()
 
-        # Drop rows with null date, location, or variants
-        metadata = metadata.dropna(subset=["date", "location", "variant"])
-        metadata_chunks.append(metadata)
+    # Count metadata in chunks to control peak memory usage, merging each
+    # chunk's counts into a running total so that memory depends on the
+    # number of distinct keys rather than the number of sequences.
+    if args.threads > 1 and os.path.exists(args.metadata):
+        print(f"Counting blocks with {args.threads} processes")
+        chunk_counts = map_blocks(
+            args.metadata,
+            partial(
+                count_block,
+                usecols=list(metadata_usecols),
+                filter_query=args.filter_query,
+                column_map=metadata_column_map,
+                min_day=min_day,
+                max_day=max_day,
+            ),
+            args.threads,
+            args.metadata_block_size,
+        )
+    else:
+        # Load metadata TSV.
+        metadata_reader = pd.read_csv(
+            args.metadata,
+            sep="\t",
+            usecols=list(metadata_usecols),
+            dtype="object",
+            chunksize=args.metadata_chunk_size,
+        )
+        print("Chunking")
+        known_dates = {}
+        chunk_counts = (
+            count_chunk(
+                filter_metadata(metadata, args.filter_query, metadata_column_map),
+                known_dates,
+                min_day,
+                max_day,
+            )
+            for metadata in metadata_reader
+        )
 
-    # Merge all chunks that passed all filters.
-    metadata = pd.concat(
-        metadata_chunks,
-        ignore_index=True,
-    )
+    counts = None
+    try:
+        for chunk in chunk_counts:
+            counts = chunk if counts is None else counts.add(chunk, fill_value=0)
+    except FilterQueryError as e:
+        print(
+            "ERROR: An error occurred when applying the filter query. "
+            "Most likely the filter query used columns that were not included in the filter columns. "
+            f"See detailed error: ({e})",
+            file=sys.stderr,
+        )
+        sys.exit(1)
 
     print("Counting")
 
-    sequence_count_by_submission = count_sequences_with_submission_date(metadata)
+    sequence_count_by_submission = decode_counts(counts)
 
     # Make sure we have the folder
     path = args.output_path
     if not os.path.exists(path):
         os.makedirs(path)
 
-    sequence_count_by_submission.to_csv(
-        f"{path}/sequence_counts_by_submission.tsv", sep="\t", index=False
+    write_table(
+        sequence_count_by_submission,
+        output_file(path, "sequence_counts_by_submission", args.output_format),
     )
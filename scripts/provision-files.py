@@ -2,6 +2,8 @@ import os
 import requests
 import argparse
 
+from seq_counts_io import read_table, table_format, write_table
+
 # Base URL for the files
 BASE_URL = "https://data.nextstrain.org/files/workflows/forecasts-ncov"
 
@@ -20,11 +22,24 @@ def download_file(url, dest):
         print(f"Failed to download {url}: {e}")
 
 def provision_file(data_provenance, variant_classification, geo_resolution, output_path):
-    """Construct the URL and download the specified file."""
+    """
+    Construct the URL and download the specified file.
+    If `output_path` has a Parquet or Arrow extension, convert the downloaded TSV to that format.
+    """
     file_name = f"{geo_resolution}.tsv.gz"
     url = f"{BASE_URL}/{data_provenance}/{variant_classification}/{file_name}"
     print(f"Constructed URL: {url}")
-    download_file(url, output_path)
+    if table_format(output_path) == "tsv":
+        download_file(url, output_path)
+        return
+
+    download_path = f"{output_path}.{file_name}"
+    download_file(url, download_path)
+    if not os.path.exists(download_path):
+        return
+    print(f"Converting to {output_path}")
+    write_table(read_table(download_path), output_path)
+    os.remove(download_path)
 
 def main():
     parser = argparse.ArgumentParser(description="Provision sequence counts data files for Snakemake workflows.")
@@ -1,95 +1,42 @@
 import argparse
 import json
+import multiprocessing
 import os
 import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 import evofr as ef
-import jax.numpy as jnp
+import jax
 import numpy as np
 import pandas as pd
 
+import batched_inference
+import fit_queue
+import innovation_inference
+import posterior_summaries
+from seq_counts_io import read_table
+
 LOCATIONS = ["USA"]
-CI_COVERAGE = [0.8]
+CI_COVERAGE = [0.8]  # TODO: Load in CI_COVERAGE from the config file
 
 ITERS = 50_000
 LEARNING_RATE = 1e-3
 NUM_SAMPLES = 100
+NUM_WARMUP = 500
 TAU = 1.0
 
-
-def _get_growth_advantage_delta(samples, data, ps, name, rel_to="other"):
-    # Unpack variant info
-    var_names = data.var_names
-    par_names = [data.parent_map[v] for v in var_names]
-
-    # Get posterior samples
-    ga = jnp.array(jnp.exp(samples["delta"]))
-    N_variant = ga.shape[-1]
-
-    # Loop over ga and make relative rel_to
-    for i, s in enumerate(var_names):
-        if s == rel_to:
-            ga = jnp.divide(ga, ga[:, i][:, None])
-
-    # ga = jnp.divide(ga, ga[:, var_names.index(rel_to)][:, None])
-
-    # Compute medians and quantiles
-    meds = jnp.median(ga, axis=0)
-    gas = []
-    for i, p in enumerate(ps):
-        up = 0.5 + p / 2
-        lp = 0.5 - p / 2
-        gas.append(jnp.quantile(ga, jnp.array([lp, up]), axis=0).T)
-
-    # Make empty dictionary
-    v_dict = dict()
-    v_dict["location"] = []
-    v_dict["variant"] = []
-    v_dict["parent"] = []
-    v_dict["median_ga_delta"] = []
-
-    for p in ps:
-        v_dict[f"ga_delta_upper_{round(p * 100)}"] = []
-        v_dict[f"ga_delta_lower_{round(p * 100)}"] = []
-
-    for variant in range(N_variant):
-        if var_names[variant] != rel_to:
-            v_dict["location"].append(name)
-            v_dict["variant"].append(var_names[variant])
-            v_dict["parent"].append(par_names[variant])
-            v_dict["median_ga_delta"].append(meds[variant])
-            for i, p in enumerate(ps):
-                v_dict[f"ga_delta_upper_{round(p * 100)}"].append(gas[i][variant, 1])
-                v_dict[f"ga_delta_lower_{round(p * 100)}"].append(gas[i][variant, 0])
-
-    return v_dict
-
-
-# TODO: Switch to relative fitness
-def get_growth_advantage_delta(posterior, pivot):
-    ga_delta_df = pd.DataFrame(
-        _get_growth_advantage_delta(
-            posterior.samples,
-            posterior.data,
-            name=posterior.name,
-            ps=CI_COVERAGE,
-            rel_to=pivot,
-        )
-    )
-    return ga_delta_df
-
-
-def get_growth_advantage(posterior, pivot):
-    ga_df = pd.DataFrame(
-        ef.posterior.get_growth_advantage(
-            posterior.samples,
-            posterior.data,
-            name=posterior.name,
-            ps=CI_COVERAGE,
-            rel_to=pivot,
-        )
-    )
-    return ga_df
+# Inference settings used where an inference profile leaves them out
+DEFAULT_INFERENCE_PROFILE = {
+    "method": "MAP",
+    "iters": ITERS,
+    "lr": LEARNING_RATE,
+    "num_samples": NUM_SAMPLES,
+    "num_warmup": NUM_WARMUP,
+    "tolerance": None,
+    "tau": TAU,
+}
 
 
 def prep_predictors(predictors, variant_freqs, predictor_names):
@@ -103,7 +50,8 @@ def prep_predictors(predictors, variant_freqs, predictor_names):
             f"The following predictor names are not columns in the DataFrame: {missing_columns}"
         )
 
-    predictors = predictors.replace("?").astype(
+    # Unknown values are given as "?"
+    predictors = predictors.replace("?", np.nan).astype(
         {name: "float" for name in predictor_names}
     )
 
@@ -112,21 +60,18 @@ def prep_predictors(predictors, variant_freqs, predictor_names):
     predictors = predictors.loc[var_names]  # Need all variants to be present...
     predictors["parent"] = predictors.index.map(variant_freqs.parent_map)
 
-    # Get delta between parents and children
-    def get_parent_delta(x, col="immune_escape"):
-        variant = x.name
-        parent = x.parent
-        # If parent and child are present generate contrast
-        if parent in predictors.index:
-            return predictors.loc[variant][col] - predictors.loc[parent][col]
-        # Gotta figure out how to deal with the nans
-        return np.nan
+    # Get delta between parents and children, where both are present,
+    # by looking up the row of each variant's parent once for all predictors
+    values = predictors[predictor_names].to_numpy(dtype=float)
+    parent_rows = predictors.index.get_indexer(predictors["parent"])
+    parent_values = np.where(
+        (parent_rows >= 0)[:, None], values[parent_rows], np.nan
+    )
+    deltas = values - parent_values
 
     # Generate delta columns
-    for name in predictor_names:
-        predictors[f"delta_{name}"] = predictors.apply(
-            lambda x: get_parent_delta(x, name), axis=1
-        )
+    for i, name in enumerate(predictor_names):
+        predictors[f"delta_{name}"] = deltas[:, i]
     return predictors
 
 
@@ -135,17 +80,13 @@ def make_features(predictors, variant_freqs, feature_names=None, intercept=True)
     if feature_names is None:
         feature_names = ["delta_immune_escape", "delta_ace2_binding"]
 
-    n_features = len(feature_names)
-
-    # Fill with features from data frame
+    # Fill with features from data frame, with NaN for variants without predictors
     N_variants = len(variant_freqs.var_names)
-    features = np.empty((N_variants, n_features))
-
-    for v, var in enumerate(variant_freqs.var_names):
-        if var in predictors.index:
-            features[v, :] = predictors.loc[var][feature_names].values
-        else:
-            features[v, :] = np.nan
+    features = (
+        predictors[feature_names]
+        .reindex(variant_freqs.var_names)
+        .to_numpy(dtype=float)
+    )
 
     # Add intercept if desired
     if intercept:
@@ -153,24 +94,356 @@ def make_features(predictors, variant_freqs, feature_names=None, intercept=True)
     return features
 
 
-# TODO: Load in ITERS, LEARNING_RATE, NUM_SAMPLES from a config file as in forecasts-ncov
-# Similarly, load in CI_COVERAGE
+def parse_predictor_names(predictor_names):
+    """
+    Predictor names given on the command line as a JSON list or comma-separated string.
+    """
+    try:
+        predictor_names = json.loads(predictor_names)
+    except json.JSONDecodeError:
+        predictor_names = predictor_names.split(",")
+
+    # Default to `immune_escape` and `ace2_binding` if not specified.
+    if predictor_names is None:
+        predictor_names = ["immune_escape", "ace2_binding"]
+    return predictor_names
+
+
+def parse_inference_profile(profile):
+    """
+    Inference profile given on the command line as a JSON object, with
+    DEFAULT_INFERENCE_PROFILE filling in any settings it leaves out.
+    """
+    profile = json.loads(profile) if profile else {}
+    unknown = [name for name in profile if name not in DEFAULT_INFERENCE_PROFILE]
+    if unknown:
+        raise ValueError(f"Unknown inference profile settings: {unknown}")
+    profile = {**DEFAULT_INFERENCE_PROFILE, **profile}
+
+    if profile["method"] not in innovation_inference.METHODS:
+        raise ValueError(
+            f"Unknown inference method {profile['method']!r}, "
+            + f"expected one of {sorted(innovation_inference.METHODS)}"
+        )
+    # YAML reads numbers such as 1e-3 or 5e4 as strings
+    for name in ["iters", "num_samples", "num_warmup"]:
+        value = float(profile[name])
+        if not value.is_integer():
+            raise ValueError(f"Inference profile setting {name} must be an integer, got {profile[name]!r}")
+        profile[name] = int(value)
+    for name in ["lr", "tau"]:
+        profile[name] = float(profile[name])
+    if profile["tolerance"] is not None:
+        profile["tolerance"] = float(profile["tolerance"])
+    return profile
+
+
+def build_location_model(
+    raw_seq,
+    raw_variant_parents,
+    location,
+    pivot,
+    predictor_path=None,
+    predictor_names=None,
+    tau=TAU,
+):
+    """
+    Data, model and predictor features (None for the uninformed model) of one location.
+    """
+    # Filtering to location of interest
+    _raw_seq = raw_seq[raw_seq.location == location].copy()
+    data = ef.InnovationSequenceCounts(_raw_seq, raw_variant_parents, pivot=pivot)
+
+    # Defining model
+    if predictor_path is None:
+        # Build uninformed model
+        return data, ef.InnovationMLR(tau=tau), None
+
+    # Build predictor-informed model
+    # Define predictors if they are supplied
+    predictors = pd.read_csv(predictor_path)
+    predictors = prep_predictors(predictors, data, predictor_names=predictor_names)
+    features = make_features(predictors, data, feature_names=predictor_names)
+    prior = ef.models.DeltaRegressionPrior(features)
+    return data, ef.InnovationMLR(tau=tau, delta_prior=prior), features
+
+
+def save_posterior(posterior, posterior_path, location):
+    os.makedirs(posterior_path, exist_ok=True)
+    posterior.save_posterior(posterior_path + f"/samples_{location}.pkl")
+    with open(posterior_path + f"/data_{location}.pkl", "wb") as f:
+        pickle.dump(posterior.data, f)
+
+
+def load_warm_start(warm_start_path, location, data):
+    """
+    Initial values for fitting `data` from the posterior of `location` saved
+    in `warm_start_path` by a previous run, or None if there is none.
+    """
+    samples_path = warm_start_path + f"/samples_{location}.pkl"
+    data_path = warm_start_path + f"/data_{location}.pkl"
+    if not (os.path.exists(samples_path) and os.path.exists(data_path)):
+        print(f"No previous posterior for {location} in {warm_start_path}, starting cold")
+        return None
+
+    previous = ef.posterior.PosteriorHandler().load_posterior(samples_path)
+    with open(data_path, "rb") as f:
+        previous_data = pickle.load(f)
+    return innovation_inference.warm_start_values(previous.samples, previous_data, data)
+
+
+def fit_location(
+    raw_seq,
+    raw_variant_parents,
+    location,
+    pivot,
+    predictor_path=None,
+    predictor_names=None,
+    posterior_path=None,
+    warm_start_path=None,
+    profile=DEFAULT_INFERENCE_PROFILE,
+):
+    """
+    Fit the model of one location as given by the inference `profile`.
+
+    Returns the posterior and the fit statistics of `fit_stats`.
+    """
+    data, model, _ = build_location_model(
+        raw_seq,
+        raw_variant_parents,
+        location,
+        pivot,
+        predictor_path,
+        predictor_names,
+        tau=profile["tau"],
+    )
+    init_values = None
+    if warm_start_path is not None:
+        init_values = load_warm_start(warm_start_path, location, data)
+
+    # Fitting model
+    print(f"Fitting {location} with {profile['method']}", flush=True)
+    start = time.perf_counter()
+    posterior, steps = innovation_inference.fit(
+        model, data, profile, name=location, init_values=init_values
+    )
+    seconds = time.perf_counter() - start
+    if steps < profile["iters"]:
+        print(f"Converged for {location} after {steps} steps", flush=True)
+    if posterior_path is not None:
+        save_posterior(posterior, posterior_path, location)
+    return posterior, fit_stats(posterior, profile, steps, seconds)
+
+
+def fit_stats(posterior, profile, steps, seconds):
+    """
+    One row of the fit statistics table: the location, inference method,
+    optimizer steps run, seconds taken and final loss of a fit.
+    """
+    losses = posterior.samples.get("losses")
+    return {
+        "location": posterior.name,
+        "method": profile["method"],
+        "steps": steps,
+        "seconds": round(seconds, 3),
+        "final_loss": float(losses[-1]) if losses is not None else np.nan,
+    }
+
+
+def fit_locations_batched(
+    raw_seq,
+    raw_variant_parents,
+    locations,
+    pivot,
+    predictor_path=None,
+    predictor_names=None,
+    posterior_path=None,
+    profile=DEFAULT_INFERENCE_PROFILE,
+    bucketed=False,
+):
+    """
+    MAP fits of `locations` as one optimization vectorized over locations,
+    returning posteriors and fit statistics in the same form as
+    `fit_location`. The time taken is split evenly between the locations.
+
+    If `bucketed`, variants and days are padded up to bucket sizes, so that
+    fits of other windows or locations with the same bucket sizes reuse the
+    compiled optimization.
+    """
+    models = [
+        build_location_model(
+            raw_seq,
+            raw_variant_parents,
+            location,
+            pivot,
+            predictor_path,
+            predictor_names,
+            tau=profile["tau"],
+        )
+        for location in locations
+    ]
+    datas = [data for data, _, _ in models]
+    features = None if predictor_path is None else [f for _, _, f in models]
+
+    print(f"Fitting {len(locations)} locations at once", flush=True)
+    start = time.perf_counter()
+    stacked = batched_inference.pad_locations(datas, features, bucketed=bucketed)
+    params, losses = batched_inference.fit_map_batched(stacked, profile["iters"], profile["lr"])
+    seconds = (time.perf_counter() - start) / len(locations)
+
+    results = []
+    for location, (data, model, _), location_params, location_losses in zip(
+        locations, models, params, losses
+    ):
+        samples = batched_inference.location_samples(model, data, location_params)
+        samples["losses"] = location_losses
+        posterior = ef.posterior.PosteriorHandler(samples=samples, data=data, name=location)
+        if posterior_path is not None:
+            save_posterior(posterior, posterior_path, location)
+        results.append((posterior, fit_stats(posterior, profile, profile["iters"], seconds)))
+    return results
+
+
+def share_counts(raw_seq):
+    """
+    Copy sequence counts into shared memory as integer codes, so that worker
+    processes can read them without each loading the counts file.
+
+    Returns the SharedMemory block, which the caller must unlink when done,
+    and a dict describing it for `_attach_counts`.
+    """
+    location_codes, locations = pd.factorize(raw_seq["location"])
+    variant_codes, variants = pd.factorize(raw_seq["variant"])
+    date_codes, dates = pd.factorize(raw_seq["date"].astype(str))
+    codes = np.vstack(
+        [location_codes, variant_codes, date_codes, raw_seq["sequences"].to_numpy()]
+    ).astype(np.int64)
+
+    block = shared_memory.SharedMemory(create=True, size=max(codes.nbytes, 1))
+    np.ndarray(codes.shape, dtype=np.int64, buffer=block.buf)[:] = codes
+    spec = {
+        "name": block.name,
+        "shape": codes.shape,
+        "locations": list(locations),
+        "variants": list(variants),
+        "dates": list(dates),
+    }
+    return block, spec
+
+
+def _attach_counts(spec):
+    """
+    Sequence counts as a DataFrame backed by the shared memory described by `spec`.
+    """
+    block = shared_memory.SharedMemory(name=spec["name"])
+    codes = np.ndarray(spec["shape"], dtype=np.int64, buffer=block.buf)
+    raw_seq = pd.DataFrame(
+        {
+            "location": pd.Categorical.from_codes(codes[0], spec["locations"]),
+            "variant": np.asarray(spec["variants"], dtype=object)[codes[1]],
+            "date": np.asarray(spec["dates"], dtype=object)[codes[2]],
+            "sequences": codes[3],
+        }
+    )
+    return block, raw_seq
 
-if __name__ == "__main__":
+
+# Sequence counts and fitting options of a worker process, set by `_init_worker`
+_worker = {}
+
+
+def _init_worker(spec, raw_variant_parents, fit_options, core_sets):
+    # Pin this worker to its own set of cores, which XLA's CPU thread pool is sized from,
+    # keep Eigen single-threaded on a single core, and keep workers off any accelerator.
+    # This has to happen before JAX initializes its backend on the first fit. JAX was
+    # already imported along with evofr and has read JAX_PLATFORMS, so set its config.
+    cores = core_sets.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    jax.config.update("jax_platforms", "cpu")
+    os.environ["XLA_FLAGS"] = (
+        os.environ.get("XLA_FLAGS", "")
+        + f" --xla_cpu_multi_thread_eigen={'true' if len(cores) > 1 else 'false'}"
+    )
+
+    _worker["block"], _worker["raw_seq"] = _attach_counts(spec)
+    _worker["raw_variant_parents"] = raw_variant_parents
+    _worker["fit_options"] = fit_options
+
+
+def _fit_location_in_worker(location):
+    return fit_location(
+        _worker["raw_seq"],
+        _worker["raw_variant_parents"],
+        location,
+        **_worker["fit_options"],
+    )
+
+
+def fit_locations_in_parallel(raw_seq, raw_variant_parents, locations, num_workers, **fit_options):
+    """
+    Fit `locations` with `fit_location` in `num_workers` worker processes and
+    return their posteriors and fit statistics in the same order.
+
+    The available cores are split evenly between the workers, each of which
+    is pinned to its share. Sequence counts are passed to the workers through
+    shared memory.
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    num_workers = min(num_workers, len(locations))
+    context = multiprocessing.get_context("spawn")
+    core_sets = context.Queue()
+    for i in range(num_workers):
+        core_sets.put(set(cores[i::num_workers]) or set(cores))
+
+    block, spec = share_counts(raw_seq)
+    try:
+        with ProcessPoolExecutor(
+            num_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(spec, raw_variant_parents, fit_options, core_sets),
+        ) as executor:
+            return list(executor.map(_fit_location_in_worker, locations))
+    finally:
+        block.close()
+        block.unlink()
+
+
+def make_serve_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--serve-queue",
+        type=str,
+        default=None,
+        help="Instead of fitting once, keep running the fits submitted to this job queue "
+        + "directory with scripts/fit_queue.py, reusing imports and compiled programs.",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=None,
+        help="With --serve-queue, stop once no fit has been submitted for this many seconds.",
+    )
+    return parser
+
+
+def make_parser():
     parser = argparse.ArgumentParser(
-        description="Given input sequence counts, estimate parent-child relative fitness differences along branches."
+        description="Given input sequence counts, estimate parent-child relative fitness differences along branches.",
+        parents=[make_serve_parser()],
     )
     parser.add_argument(
         "--seq-counts",
         type=str,
         required=True,
-        help="input TSV of collapsed sequence counts",
+        help="input TSV, Parquet or Arrow file of collapsed sequence counts",
     )
     parser.add_argument(
         "--pango-relationships",
         type=str,
         required=True,
-        help="input TSV of pango-variant-relationships",
+        help="input TSV, Parquet or Arrow file of pango-variant-relationships",
     )
     parser.add_argument(
         "--predictor-path",
@@ -208,74 +481,164 @@ if __name__ == "__main__":
         default=None,
         help="The path to save the posteriors by location.",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--locations",
+        type=str,
+        nargs="+",
+        default=LOCATIONS,
+        help="Locations to fit, or 'all' for every location in the sequence counts.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=1,
+        help="Number of processes fitting locations in parallel, each pinned to its own share of the CPU cores.",
+    )
+    parser.add_argument(
+        "--batched",
+        action="store_true",
+        help="Fit all locations in one MAP optimization vectorized over locations, "
+        + "which compiles the model once rather than once per location.",
+    )
+    parser.add_argument(
+        "--shape-buckets",
+        action="store_true",
+        help="Pad variants and days up to a few bucket sizes, masked out of the model, "
+        + "so that fits with the same bucket sizes share compiled programs. "
+        + "Without --batched, locations are fit one after another.",
+    )
+    parser.add_argument(
+        "--warm-start-path",
+        type=str,
+        default=None,
+        help="Path to the posteriors by location of a previous, overlapping window "
+        + "to start fitting from instead of from scratch.",
+    )
+    parser.add_argument(
+        "--inference-profile",
+        type=str,
+        default=None,
+        help="Inference settings as a JSON object with any of "
+        + f"{list(DEFAULT_INFERENCE_PROFILE)}, where method is one of "
+        + f"{sorted(innovation_inference.METHODS)}. Defaults to {DEFAULT_INFERENCE_PROFILE}.",
+    )
+    parser.add_argument(
+        "--early-stop-tolerance",
+        type=float,
+        default=None,
+        help="Stop fitting once the mean loss changes by less than this fraction "
+        + f"between consecutive blocks of {innovation_inference.CHECK_EVERY} steps. "
+        + "Overrides the tolerance of the inference profile.",
+    )
+    parser.add_argument(
+        "--compilation-cache-dir",
+        type=str,
+        default=None,
+        help="Directory of a persistent JAX compilation cache, so that later runs "
+        + "load rather than recompile the programs compiled by earlier ones.",
+    )
+    parser.add_argument(
+        "--fit-stats-path",
+        type=str,
+        default=None,
+        help="output path for the inference method, steps, seconds and final loss of each location's fit",
+    )
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+
+    if args.compilation_cache_dir is not None:
+        innovation_inference.enable_compilation_cache(args.compilation_cache_dir)
+
+    try:
+        profile = parse_inference_profile(args.inference_profile)
+    except (ValueError, json.JSONDecodeError) as e:
+        parser.error(f"Invalid --inference-profile: {e}")
+    if args.early_stop_tolerance is not None:
+        profile["tolerance"] = args.early_stop_tolerance
+
+    # Both fit the masked model of batched_inference
+    if args.batched or args.shape_buckets:
+        if args.warm_start_path or profile["tolerance"] is not None:
+            parser.error(
+                "--batched and --shape-buckets cannot be combined with --warm-start-path or early stopping"
+            )
+        if profile["method"] != "MAP":
+            parser.error("--batched and --shape-buckets only support the MAP inference method")
 
     # Load data
-    raw_seq = pd.read_csv(args.seq_counts, sep="\t")
-    raw_variant_parents = pd.read_csv(args.pango_relationships, sep="\t")
+    raw_seq = read_table(args.seq_counts)
+    raw_variant_parents = read_table(args.pango_relationships)
     raw_variant_parents = raw_variant_parents.rename(
         columns={"closest_parent": "parent"}
     )
 
-    # Use all location present unless instructed otherwise
-    # locations = pd.unique(raw_seq["location"])
-    locations = LOCATIONS  # TODO: Filter locations earlier within config
-
-    def _get_posterior(location, pivot):
-        # Filtering to location of interest
-        _raw_seq = raw_seq[raw_seq.location == location].copy()
-        data = ef.InnovationSequenceCounts(_raw_seq, raw_variant_parents, pivot=pivot)
-
-        # Defining model
-        if args.predictor_path is None:
-            # Build uninformed model
-            model = ef.InnovationMLR(tau=TAU)
-        else:
-            # Build predictor-informed model
-            # Define predictors if they are supplied
-            predictors = pd.read_csv(args.predictor_path)
-            try:
-                predictor_names = json.loads(args.predictor_names)
-            except json.JSONDecodeError:
-                predictor_names = args.predictor_names.split(",")
-
-            # Default to `immune_escape` and `ace2_binding` if not specified.
-            if predictor_names is None:
-                predictor_names = ["immune_escape", "ace2_binding"]
-            predictors = prep_predictors(
-                predictors, data, predictor_names=predictor_names
+    # Use all location present if asked to
+    if args.locations == ["all"]:
+        locations = list(pd.unique(raw_seq["location"]))
+    else:
+        locations = args.locations  # TODO: Filter locations earlier within config
+
+    fit_options = {
+        "pivot": args.pivot,
+        "predictor_path": args.predictor_path,
+        "predictor_names": (
+            parse_predictor_names(args.predictor_names)
+            if args.predictor_path is not None
+            else None
+        ),
+        "posterior_path": args.posterior_path,
+        "profile": profile,
+    }
+    if args.batched:
+        results = fit_locations_batched(
+            raw_seq, raw_variant_parents, locations, bucketed=args.shape_buckets, **fit_options
+        )
+    elif args.shape_buckets:
+        results = [
+            result
+            for location in locations
+            for result in fit_locations_batched(
+                raw_seq, raw_variant_parents, [location], bucketed=True, **fit_options
+            )
+        ]
+    else:
+        fit_options["warm_start_path"] = args.warm_start_path
+        if args.num_workers > 1 and len(locations) > 1:
+            results = fit_locations_in_parallel(
+                raw_seq, raw_variant_parents, locations, args.num_workers, **fit_options
             )
-            features = make_features(predictors, data, feature_names=predictor_names)
-            prior = ef.models.DeltaRegressionPrior(features)
-            model = ef.InnovationMLR(tau=TAU, delta_prior=prior)
-
-        # Defining inference method
-        # inference_method = ef.InferFullRank(ITERS, LEARNING_RATE, NUM_SAMPLES)
-        inference_method = ef.InferMAP(ITERS, LEARNING_RATE)
-
-        # Fitting model
-        print(f"Fitting {location}")
-        posterior = inference_method.fit(model, data, name=location)
-        if args.posterior_path is not None:
-            os.makedirs(args.posterior_path, exist_ok=True)
-            posterior.save_posterior(args.posterior_path + f"/samples_{location}.pkl")
-            with open(args.posterior_path + f"/data_{location}.pkl", "wb") as f:
-                pickle.dump(posterior.data, f)
-        return posterior
-
-    posteriors = [_get_posterior(location, pivot=args.pivot) for location in locations]
+        else:
+            results = [
+                fit_location(raw_seq, raw_variant_parents, location, **fit_options)
+                for location in locations
+            ]
+    posteriors = [posterior for posterior, _ in results]
+
+    if args.fit_stats_path is not None:
+        pd.DataFrame([stats for _, stats in results]).to_csv(
+            args.fit_stats_path, sep="\t", index=False
+        )
 
     # Export
     print("Exporting growth advantages")
-    ga_df = pd.concat(
-        [get_growth_advantage(posterior, pivot=args.pivot) for posterior in posteriors]
-    )
+    tables = [
+        posterior_summaries.growth_advantage_tables(posterior, CI_COVERAGE, args.pivot)
+        for posterior in posteriors
+    ]
+    ga_df = pd.concat([ga for ga, _ in tables])
     ga_df.to_csv(args.growth_advantage_path, sep="\t", index=False)
 
-    ga_delta_df = pd.concat(
-        [
-            get_growth_advantage_delta(posterior, pivot=args.pivot)
-            for posterior in posteriors
-        ]
-    )
+    ga_delta_df = pd.concat([ga_delta for _, ga_delta in tables])
     ga_delta_df.to_csv(args.growth_advantage_delta_path, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    serve_args, _ = make_serve_parser().parse_known_args()
+    if serve_args.serve_queue is None:
+        main()
+    else:
+        fit_queue.serve(serve_args.serve_queue, main, idle_timeout=serve_args.idle_timeout)
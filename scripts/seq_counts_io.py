@@ -0,0 +1,128 @@
+"""
+Read and write the tabular intermediates of the sequence-count pipeline.
+
+The format is chosen from the file extension: `.parquet` for Parquet,
+`.arrow` or `.feather` for Arrow IPC, and TSV (optionally compressed) for
+anything else. Columnar files store location, variant and clade columns
+dictionary-encoded and date columns as date32, but are read back with the
+same column types as the equivalent TSV, so scripts behave identically
+whichever format they are given. Only the columnar formats need pyarrow.
+"""
+import os
+
+import pandas as pd
+
+FORMAT_EXTENSIONS = {
+    "tsv": ".tsv",
+    "parquet": ".parquet",
+    "arrow": ".arrow",
+}
+
+# Columns stored dictionary-encoded and as date32 in columnar files
+DICTIONARY_COLUMNS = {"location", "variant", "clade", "closest_parent"}
+DATE_COLUMNS = {"date", "date_submitted"}
+
+
+def table_format(path):
+    """
+    Return 'parquet', 'arrow' or 'tsv' depending on the extension of `path`.
+
+    >>> table_format("data/ba2/collapsed_seq_counts.parquet")
+    'parquet'
+    >>> table_format("data/gisaid/pango_lineages/global.tsv.gz")
+    'tsv'
+    """
+    extension = os.path.splitext(path)[1]
+    if extension == ".parquet":
+        return "parquet"
+    if extension in {".arrow", ".feather"}:
+        return "arrow"
+    return "tsv"
+
+
+def read_table(path, usecols=None, dtype=None, keep_default_na=True):
+    """
+    Read a TSV, Parquet or Arrow IPC table into a DataFrame.
+
+    `usecols`, `dtype` and `keep_default_na` are as for `pandas.read_csv`.
+    For columnar files, dictionary and date columns come back as strings,
+    and empty strings as missing values unless `keep_default_na` is False,
+    as they would from a TSV. Columns given a 'category' dtype stay
+    dictionary-encoded.
+    """
+    if table_format(path) == "tsv":
+        return pd.read_csv(
+            path, sep="\t", usecols=usecols, dtype=dtype, keep_default_na=keep_default_na
+        )
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    if table_format(path) == "parquet":
+        table = pq.read_table(path, columns=usecols)
+    else:
+        table = feather.read_table(path, columns=usecols)
+
+    dtype = dtype or {}
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if dtype.get(name) == "category" and not pa.types.is_dictionary(column.type):
+            column = column.dictionary_encode()
+        elif dtype.get(name) != "category":
+            if pa.types.is_dictionary(column.type):
+                column = column.cast(column.type.value_type)
+            if pa.types.is_date(column.type):
+                column = column.cast(pa.string())
+            is_string = pa.types.is_string(column.type) or pa.types.is_large_string(column.type)
+            if keep_default_na and is_string:
+                column = pc.if_else(pc.equal(column, ""), None, column)
+        columns.append(column)
+    df = pa.table(columns, names=table.column_names).to_pandas()
+
+    remaining_dtype = {k: v for k, v in dtype.items() if k in df.columns and v != "category"}
+    if remaining_dtype:
+        df = df.astype(remaining_dtype)
+    return df
+
+
+def write_table(df, path):
+    """
+    Write a DataFrame as TSV, Parquet or Arrow IPC depending on the extension of `path`.
+    """
+    if table_format(path) == "tsv":
+        df.to_csv(path, sep="\t", index=False)
+        return
+
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    df = df.copy()
+    for name in df.columns:
+        if name in DICTIONARY_COLUMNS:
+            # missing values are written as empty strings, as in a TSV
+            df[name] = df[name].astype("category")
+            if df[name].isna().any():
+                df[name] = df[name].cat.add_categories([""]).fillna("")
+        elif name in DATE_COLUMNS:
+            df[name] = pd.to_datetime(df[name])
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    # store dates as date32 rather than pandas timestamps
+    for i, name in enumerate(table.column_names):
+        if name in DATE_COLUMNS:
+            table = table.set_column(i, name, table.column(i).cast(pa.date32()))
+
+    if table_format(path) == "parquet":
+        pq.write_table(table, path)
+    else:
+        feather.write_feather(table, path)
+
+
+def output_file(path, name, output_format):
+    """
+    Path of file `name` in directory `path` with the extension for `output_format`.
+    """
+    return os.path.join(path, name + FORMAT_EXTENSIONS[output_format])
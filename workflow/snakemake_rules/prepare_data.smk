@@ -67,7 +67,7 @@ def _get_analysis_period_option(wildcards, option_name):
 
 rule provision_sequence_counts:
     output:
-        "data/{data_provenance}/{variant_classification}/{geo_resolution}.tsv.gz"
+        "data/{data_provenance}/{variant_classification}/{geo_resolution}." + PROVISIONED_EXT
     shell:
         """
         python ./scripts/provision-files.py \
@@ -77,16 +77,27 @@ rule provision_sequence_counts:
             --output-path {output}
         """
 
+rule provision_alias_key:
+    "Downloading Pango alias key once per alias_key_version, so lineage scripts share a local copy"
+    output:
+        alias_key = ALIAS_KEY
+    params:
+        url = config.get("alias_key_url", "https://raw.githubusercontent.com/cov-lineages/pango-designation/master/pango_designation/alias_key.json")
+    shell:
+        """
+        curl -fsSL {params.url} -o {output.alias_key}
+        """
+
 rule prepare_clade_data:
     "Preparing clade counts for analysis"
     input:
-        sequence_counts = lambda wildcards: "data/{data_provenance}/{variant_classification}/{geo_resolution}.tsv.gz".format(
+        sequence_counts = lambda wildcards: ("data/{data_provenance}/{variant_classification}/{geo_resolution}." + PROVISIONED_EXT).format(
             data_provenance= get_analysis_config(wildcards).get("data_provenance", "gisaid"),
             variant_classification=get_analysis_config(wildcards).get("variant_classification", "pango_lineages"),
             geo_resolution=get_analysis_config(wildcards).get("geo_resolution", "global")
         )
     output:
-        sequence_counts = "data/{analysis_period}/prepared_seq_counts.tsv"
+        sequence_counts = "data/{analysis_period}/prepared_seq_counts." + INTERMEDIATE_EXT
     log:
         "logs/{analysis_period}/prepare_clade_data.txt"
     params:
@@ -115,10 +126,12 @@ rule prepare_clade_data:
 rule collapse_sequence_counts:
     "Collapsing Pango lineages, based on sequence count threshold"
     input:
-        sequence_counts = "data/{analysis_period}/prepared_seq_counts.tsv"
+        sequence_counts = "data/{analysis_period}/prepared_seq_counts." + INTERMEDIATE_EXT,
+        alias_key = ALIAS_KEY
     output:
-        collapsed_counts = "data/{analysis_period}/collapsed_seq_counts.tsv"
+        collapsed_counts = "data/{analysis_period}/collapsed_seq_counts." + INTERMEDIATE_EXT
     params:
+        lineage_index = LINEAGE_INDEX,
         collapse_threshold = lambda wildcards: _get_prepare_data_option_analysis(wildcards, 'collapse_threshold'),
         force_include = lambda wildcards: _get_analysis_period_option(wildcards, 'force_include')
     shell:
@@ -126,18 +139,25 @@ rule collapse_sequence_counts:
         python ./scripts/collapse-lineage-counts.py \
             --seq-counts {input.sequence_counts} \
             --output-seq-counts {output.collapsed_counts} \
+            --alias-key {input.alias_key} \
+            --lineage-index {params.lineage_index} \
             {params.collapse_threshold} \
             {params.force_include}
         """
 
 rule get_pango_relationships:
     input:
-        sequence_counts = "data/{analysis_period}/collapsed_seq_counts.tsv"
+        sequence_counts = "data/{analysis_period}/collapsed_seq_counts." + INTERMEDIATE_EXT,
+        alias_key = ALIAS_KEY
     output:
-        pango_relationships = "data/{analysis_period}/pango_variant_relationships.tsv"
+        pango_relationships = "data/{analysis_period}/pango_variant_relationships." + INTERMEDIATE_EXT
+    params:
+        lineage_index = LINEAGE_INDEX
     shell:
         """
         python ./scripts/prepare-pango-relationships.py \
             --seq-counts {input.sequence_counts} \
+            --alias-key {input.alias_key} \
+            --lineage-index {params.lineage_index} \
             --output-relationships {output.pango_relationships}
         """
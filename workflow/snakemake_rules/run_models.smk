@@ -1,3 +1,5 @@
+import json
+
 def _get_analysis_period_option(wildcards, option_name):
     """
     Return the option for analysis period from the config based on the analysis period values.
@@ -15,48 +17,124 @@ def _get_analysis_period_option(wildcards, option_name):
         return f'--{option_name} {option_value}'
     return ''
 
+def _get_locations(wildcards):
+    """
+    Return the list of locations to fit for the analysis period, or an empty list to use the model's default.
+    """
+    return config.get('analysis_period', {}) \
+                 .get(wildcards.analysis_period, {}) \
+                 .get('locations', [])
+
+def _get_num_workers(wildcards):
+    """
+    Return the number of worker processes to fit the analysis period's locations with:
+    one per location, or all cores given to Snakemake if every location is fit.
+    """
+    locations = _get_locations(wildcards)
+    if locations == ["all"]:
+        return workflow.cores
+    return max(len(locations), 1)
+
+def _get_locations_option(wildcards):
+    locations = _get_locations(wildcards)
+    if locations:
+        return "--locations " + " ".join(f"'{location}'" for location in locations)
+    return ''
+
+def _get_inference_profile_option(wildcards):
+    """
+    Return the inference profile named by the analysis period's `inference_profile`
+    (or "default") in config['inference_profiles'] as "--inference-profile '<JSON>'",
+    or an empty string to use the model's defaults if no such profiles are configured.
+    """
+    profiles = config.get('inference_profiles', {})
+    name = config.get('analysis_period', {}) \
+                 .get(wildcards.analysis_period, {}) \
+                 .get('inference_profile', 'default')
+    if name not in profiles:
+        if name != 'default':
+            raise ValueError(f"Unknown inference profile {name!r} for analysis period {wildcards.analysis_period!r}")
+        return ''
+    return f"--inference-profile '{json.dumps(profiles[name])}'"
+
+def _get_innovation_model_command():
+    """
+    Return the command running scripts/run-innovation-model.py, with the JAX compilation
+    cache in config['compilation_cache_dir'] if set. If config['fit_queue'] is set, fits
+    are submitted to the workers serving that job queue directory instead, failing if
+    they do not finish within config['fit_queue_timeout'] seconds.
+    """
+    command = "python ./scripts/run-innovation-model.py"
+    if config.get('fit_queue'):
+        command = "python ./scripts/fit_queue.py"
+        command += f" --queue {config['fit_queue']}"
+        if config.get('fit_queue_timeout'):
+            command += f" --timeout {config['fit_queue_timeout']}"
+        command += " --"
+    if config.get('compilation_cache_dir'):
+        command += f" --compilation-cache-dir {config['compilation_cache_dir']}"
+    return command
+
 rule innovation_model:
     input:
-        sequence_counts = "data/{analysis_period}/collapsed_seq_counts.tsv",
-        pango_relationships = "data/{analysis_period}/pango_variant_relationships.tsv",
+        sequence_counts = "data/{analysis_period}/collapsed_seq_counts." + INTERMEDIATE_EXT,
+        pango_relationships = "data/{analysis_period}/pango_variant_relationships." + INTERMEDIATE_EXT,
     params:
+        run_model = _get_innovation_model_command(),
         pivot = lambda wildcards: _get_analysis_period_option(wildcards, 'pivot'),
+        locations = lambda wildcards: _get_locations_option(wildcards),
+        inference_profile = lambda wildcards: _get_inference_profile_option(wildcards),
     	posteriors = "results/{analysis_period}/posteriors"
     output:
         growth_advantages = "results/{analysis_period}/growth_advantages.tsv",
-        growth_advantages_delta = "results/{analysis_period}/growth_advantages_delta.tsv"
+        growth_advantages_delta = "results/{analysis_period}/growth_advantages_delta.tsv",
+        fit_stats = "results/{analysis_period}/fit_stats.tsv"
+    threads: lambda wildcards: _get_num_workers(wildcards)
     shell:
         """
-        python ./scripts/run-innovation-model.py \
+        {params.run_model} \
             --seq-counts {input.sequence_counts} \
             --pango-relationships {input.pango_relationships} \
             --growth-advantage-path {output.growth_advantages} \
             --growth-advantage-delta-path {output.growth_advantages_delta} \
+            --fit-stats-path {output.fit_stats} \
             --posterior-path {params.posteriors} \
+            --num-workers {threads} \
+            {params.locations} \
+            {params.inference_profile} \
             {params.pivot}
         """
 
 rule innovation_model_informed:
     input:
-        sequence_counts = "data/{analysis_period}/collapsed_seq_counts.tsv",
-        pango_relationships = "data/{analysis_period}/pango_variant_relationships.tsv",
+        sequence_counts = "data/{analysis_period}/collapsed_seq_counts." + INTERMEDIATE_EXT,
+        pango_relationships = "data/{analysis_period}/pango_variant_relationships." + INTERMEDIATE_EXT,
         predictor_path = "data/{analysis_period}/phenotypes/lineage_phenotypes.csv"
     params:
+        run_model = _get_innovation_model_command(),
         predictor_names = lambda wildcards: _get_predictor_names(wildcards),
         pivot = lambda wildcards: _get_analysis_period_option(wildcards, 'pivot'),
+        locations = lambda wildcards: _get_locations_option(wildcards),
+        inference_profile = lambda wildcards: _get_inference_profile_option(wildcards),
     	posteriors = "results/{analysis_period}/posteriors/informed"
     output:
         growth_advantages = "results/{analysis_period}/informed/growth_advantages.tsv",
-        growth_advantages_delta = "results/{analysis_period}/informed/growth_advantages_delta.tsv"
+        growth_advantages_delta = "results/{analysis_period}/informed/growth_advantages_delta.tsv",
+        fit_stats = "results/{analysis_period}/informed/fit_stats.tsv"
+    threads: lambda wildcards: _get_num_workers(wildcards)
     shell:
         """
-        python ./scripts/run-innovation-model.py \
+        {params.run_model} \
             --seq-counts {input.sequence_counts} \
             --pango-relationships {input.pango_relationships} \
             --predictor-path {input.predictor_path} \
             --predictor-names {params.predictor_names} \
             --growth-advantage-path {output.growth_advantages} \
             --growth-advantage-delta-path {output.growth_advantages_delta} \
+            --fit-stats-path {output.fit_stats} \
             --posterior-path {params.posteriors} \
+            --num-workers {threads} \
+            {params.locations} \
+            {params.inference_profile} \
             {params.pivot}
         """
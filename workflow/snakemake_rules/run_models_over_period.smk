@@ -3,126 +3,211 @@ rule process_metadata:
     input:
         metadata = lambda wildcards: "data/gisaid_metadata_filtered.tsv.gz"
     output:
-        sequence_counts_by_submission = "data/{analysis_period}/sequence_counts_by_submission.tsv"
+        sequence_counts_by_submission = "data/{analysis_period}/sequence_counts_by_submission." + INTERMEDIATE_EXT
     params:
         obs_date_min = lambda wildcards: _get_analysis_period_option(wildcards, 'obs_date_min'),
         obs_date_max = lambda wildcards: _get_analysis_period_option(wildcards, 'obs_date_max'),
         obs_date_interval = lambda wildcards: _get_analysis_period_option(wildcards, 'interval'),
         num_days_context = lambda wildcards: _get_analysis_period_option(wildcards, 'num_days_context'),
-        output_path = "data/{analysis_period}"
+        output_path = "data/{analysis_period}",
+        output_format = INTERMEDIATE_EXT
+    threads: workflow.cores
     shell:
         """
         python ./scripts/process-metadata-by-submission.py \
             --metadata {input.metadata} \
+            --threads {threads} \
             --clade-column "Nextclade_pango" \
             --output-path {params.output_path} \
             --filter-columns "QC_overall_status" \
             --filter-query "QC_overall_status != 'bad'" \
+            --output-format {params.output_format} \
             {params.obs_date_min}\
             {params.obs_date_max} \
             {params.num_days_context}
         """
 
 rule observe_over_period:
+    "Observing sequence counts on every observation date of the period in one pass"
     input:
-        sequence_counts_by_submission = "data/{analysis_period}/sequence_counts_by_submission.tsv"
+        sequence_counts_by_submission = "data/{analysis_period}/sequence_counts_by_submission." + INTERMEDIATE_EXT
     output:
-        sequence_counts_dated = "data/{analysis_period}/prepared_seq_counts_{obs_date}.tsv"
+        sequence_counts_dated = directory("data/{analysis_period}/observed_seq_counts")
     params:
         obs_date_min = lambda wildcards: _get_analysis_period_option(wildcards, 'obs_date_min'),
+        obs_date_max = lambda wildcards: _get_analysis_period_option(wildcards, 'obs_date_max'),
+        obs_date_interval = lambda wildcards: _get_analysis_period_option(wildcards, 'interval'),
         num_days_context = lambda wildcards: _get_analysis_period_option(wildcards, 'num_days_context'),
-        output_path = lambda wildcards: f"data/{wildcards.analysis_period}",
-        obs_date = lambda wildcards: wildcards.obs_date
+        output_format = INTERMEDIATE_EXT
     shell:
         """
         python ./scripts/observe-sequence-counts.py \
             --sequence-counts-by-submission {input.sequence_counts_by_submission} \
-            --output-path {params.output_path} \
-            --obs-date {params.obs_date} \
+            --output-path {output.sequence_counts_dated} \
+            --output-format {params.output_format} \
             {params.obs_date_min} \
+            {params.obs_date_max} \
+            {params.obs_date_interval} \
             {params.num_days_context}
         """
 
 rule collapse_over_period:
     "Collapsing Pango lineages, based on sequence count threshold"
     input:
-        sequence_counts = "data/{analysis_period}/prepared_seq_counts_{obs_date}.tsv"
+        sequence_counts_dated = "data/{analysis_period}/observed_seq_counts",
+        alias_key = ALIAS_KEY
     output:
-        collapsed_counts = "data/{analysis_period}/collapsed_seq_counts_{obs_date}.tsv"
+        collapsed_counts = "data/{analysis_period}/collapsed_seq_counts_{obs_date}." + INTERMEDIATE_EXT
     params:
-        collapse_threshold = lambda wildcards: _get_prepare_data_option_analysis(wildcards, 'collapse_threshold')
+        lineage_index = LINEAGE_INDEX,
+        collapse_threshold = lambda wildcards: _get_prepare_data_option_analysis(wildcards, 'collapse_threshold'),
+        ext = INTERMEDIATE_EXT
     shell:
         """
         python ./scripts/collapse-lineage-counts.py \
-            --seq-counts {input.sequence_counts} \
+            --seq-counts {input.sequence_counts_dated}/prepared_seq_counts_{wildcards.obs_date}.{params.ext} \
             --output-seq-counts {output.collapsed_counts} \
+            --alias-key {input.alias_key} \
+            --lineage-index {params.lineage_index} \
             {params.collapse_threshold}
         """
 
 rule get_pango_relationships_over_period:
     input:
-        sequence_counts = "data/{analysis_period}/collapsed_seq_counts_{obs_date}.tsv"
+        sequence_counts = "data/{analysis_period}/collapsed_seq_counts_{obs_date}." + INTERMEDIATE_EXT,
+        alias_key = ALIAS_KEY
     output:
-        pango_relationships = "data/{analysis_period}/pango_variant_relationships_{obs_date}.tsv"
+        pango_relationships = "data/{analysis_period}/pango_variant_relationships_{obs_date}." + INTERMEDIATE_EXT
+    params:
+        lineage_index = LINEAGE_INDEX
     shell:
         """
         python ./scripts/prepare-pango-relationships.py \
             --seq-counts {input.sequence_counts} \
+            --alias-key {input.alias_key} \
+            --lineage-index {params.lineage_index} \
             --output-relationships {output.pango_relationships}
         """
     
+def _get_previous_obs_date(wildcards):
+    """
+    Return the observation date before wildcards.obs_date in the analysis period,
+    if the analysis period is fit with `warm_start`, or else None.
+    """
+    if not config.get('analysis_period', {}).get(wildcards.analysis_period, {}).get('warm_start', False):
+        return None
+    obs_dates = _get_date_range(wildcards.analysis_period)
+    index = obs_dates.index(wildcards.obs_date)
+    return obs_dates[index - 1] if index > 0 else None
+
+def _get_warm_start_input(wildcards, results_path="results/{analysis_period}"):
+    previous_obs_date = _get_previous_obs_date(wildcards)
+    if previous_obs_date is None:
+        return []
+    return (results_path + "/growth_advantages_{obs_date}.tsv").format(
+        analysis_period=wildcards.analysis_period,
+        obs_date=previous_obs_date
+    )
+
+def _get_warm_start_option(wildcards, posteriors_subdir=""):
+    previous_obs_date = _get_previous_obs_date(wildcards)
+    if previous_obs_date is None:
+        return ''
+    return f"--warm-start-path results/{wildcards.analysis_period}/posteriors_{previous_obs_date}{posteriors_subdir}"
+
+def _get_shape_buckets_option(wildcards):
+    """
+    Return "--shape-buckets" if the analysis period is fit with `shape_buckets`, so that
+    windows whose variants and days round up to the same bucket sizes share compiled fits.
+    """
+    if config.get('analysis_period', {}).get(wildcards.analysis_period, {}).get('shape_buckets', False):
+        return '--shape-buckets'
+    return ''
+
 rule run_innovation_model_over_period:
     input:
-        sequence_counts = lambda wildcards: "data/{analysis_period}/collapsed_seq_counts_{obs_date}.tsv".format(
+        sequence_counts = lambda wildcards: ("data/{analysis_period}/collapsed_seq_counts_{obs_date}." + INTERMEDIATE_EXT).format(
             analysis_period = wildcards.analysis_period,
             obs_date = wildcards.obs_date
             ),
-        pango_relationships = "data/{analysis_period}/pango_variant_relationships_{obs_date}.tsv",
+        pango_relationships = "data/{analysis_period}/pango_variant_relationships_{obs_date}." + INTERMEDIATE_EXT,
+        previous_window = lambda wildcards: _get_warm_start_input(wildcards),
     params:
+        run_model = _get_innovation_model_command(),
         pivot = lambda wildcards: _get_analysis_period_option(wildcards, 'pivot'),
+        locations = lambda wildcards: _get_locations_option(wildcards),
+        inference_profile = lambda wildcards: _get_inference_profile_option(wildcards),
+        warm_start = lambda wildcards: _get_warm_start_option(wildcards),
+        early_stop_tolerance = lambda wildcards: _get_analysis_period_option(wildcards, 'early_stop_tolerance'),
+        shape_buckets = lambda wildcards: _get_shape_buckets_option(wildcards),
     	posteriors = lambda wildcards: "results/{analysis_period}/posteriors_{obs_date}".format(
             analysis_period = wildcards.analysis_period,
             obs_date = wildcards.obs_date
             ),
     output:
         growth_advantages = "results/{analysis_period}/growth_advantages_{obs_date}.tsv",
-        growth_advantages_delta = "results/{analysis_period}/growth_advantages_delta_{obs_date}.tsv"
+        growth_advantages_delta = "results/{analysis_period}/growth_advantages_delta_{obs_date}.tsv",
+        fit_stats = "results/{analysis_period}/fit_stats_{obs_date}.tsv"
+    threads: lambda wildcards: _get_num_workers(wildcards)
     shell:
         """
-        python ./scripts/run-innovation-model.py \
+        {params.run_model} \
             --seq-counts {input.sequence_counts} \
             --pango-relationships {input.pango_relationships} \
             --growth-advantage-path {output.growth_advantages} \
             --growth-advantage-delta-path {output.growth_advantages_delta} \
+            --fit-stats-path {output.fit_stats} \
             --posterior-path {params.posteriors} \
+            --num-workers {threads} \
+            {params.locations} \
+            {params.inference_profile} \
+            {params.warm_start} \
+            {params.early_stop_tolerance} \
+            {params.shape_buckets} \
             {params.pivot}
         """
 
 rule run_innovation_model_informed_over_period:
     input:
         sequence_counts = lambda wildcards: expand(
-            "data/{analysis_period}/collapsed_seq_counts_{obs_date}.tsv",
+            "data/{analysis_period}/collapsed_seq_counts_{obs_date}." + INTERMEDIATE_EXT,
             analysis_period = wildcards.analysis_period,
             obs_date = wildcards.obs_date
         ),
-        pango_relationships = "data/{analysis_period}/pango_variant_relationships.tsv",
+        pango_relationships = "data/{analysis_period}/pango_variant_relationships." + INTERMEDIATE_EXT,
         predictor_path = "data/{analysis_period}/lineage_phenotypes.csv",
+        previous_window = lambda wildcards: _get_warm_start_input(wildcards, "results/{analysis_period}/informed"),
     params:
+        run_model = _get_innovation_model_command(),
         predictor_names = lambda wildcards: _get_predictor_names(wildcards),
         pivot = lambda wildcards: _get_analysis_period_option(wildcards, 'pivot'),
+        locations = lambda wildcards: _get_locations_option(wildcards),
+        inference_profile = lambda wildcards: _get_inference_profile_option(wildcards),
+        warm_start = lambda wildcards: _get_warm_start_option(wildcards, "/informed"),
+        early_stop_tolerance = lambda wildcards: _get_analysis_period_option(wildcards, 'early_stop_tolerance'),
+        shape_buckets = lambda wildcards: _get_shape_buckets_option(wildcards),
     	posteriors = "results/{analysis_period}/posteriors_{obs_date}/informed"
     output:
         growth_advantages = "results/{analysis_period}/informed/growth_advantages_{obs_date}.tsv",
-        growth_advantages_delta = "results/{analysis_period}/informed/growth_advantages_delta_{obs_date}.tsv"
+        growth_advantages_delta = "results/{analysis_period}/informed/growth_advantages_delta_{obs_date}.tsv",
+        fit_stats = "results/{analysis_period}/informed/fit_stats_{obs_date}.tsv"
+    threads: lambda wildcards: _get_num_workers(wildcards)
     shell:
         """
-        python ./scripts/run-innovation-model.py \
+        {params.run_model} \
             --seq-counts {input.sequence_counts} \
             --pango-relationships {input.pango_relationships} \
             --predictor-path {input.predictor_path} \
             --predictor-names {params.predictor_names} \
             --growth-advantage-path {output.growth_advantages} \
             --growth-advantage-delta-path {output.growth_advantages_delta} \
+            --fit-stats-path {output.fit_stats} \
             --posterior-path {params.posteriors} \
+            --num-workers {threads} \
+            {params.locations} \
+            {params.inference_profile} \
+            {params.warm_start} \
+            {params.early_stop_tolerance} \
+            {params.shape_buckets} \
             {params.pivot}
         """